@@ -29,6 +29,8 @@ myriota_test 'which pip || which pip3'
 myriota_test 'python -c "import serial"'
 myriota_test 'python -c "import requests"'
 myriota_test 'python -c "from OpenSSL import crypto"'
+myriota_test 'which python3'
+myriota_test 'python3 -c "import requests"'
 myriota_test 'which curl'
 myriota_test 'arm-none-eabi-gcc --version | grep -q 7.2.1'
 myriota_test 'which gcc || which clang'
@@ -23,14 +23,16 @@ elif $(cat /etc/os-release | grep -q "Ubuntu 16.04"); then
   echo -e "\t======================================================================="
   echo -e "\tWARNING: Ubuntu 16.04 is not supported. Some installations may fail"
   echo -e "\t======================================================================="
-  sudo apt-get -y install make curl python bzip2
+  sudo apt-get -y install make curl python bzip2 python3 python3-pip
   curl -O https://bootstrap.pypa.io/2.7/get-pip.py
   sudo python get-pip.py
   sudo python -m pip install --upgrade "pip < 21.0"
   sudo -H pip install -r requirements.txt
+  sudo -H pip3 install -r requirements.txt
 else
-    sudo apt-get -y install make curl python python-pip
+    sudo apt-get -y install make curl python python-pip python3 python3-pip
     sudo -H pip install -r requirements.txt
+    sudo -H pip3 install -r requirements.txt
 fi
 curl -O https://static.myriota.com/gcc-arm-none-eabi-7-2017-q4-major-linux.tar.bz2
 sudo mkdir -p /opt/gcc-arm
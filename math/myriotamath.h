@@ -478,6 +478,21 @@ class Resample {
   virtual T operator()(int64_t n) const = 0;
   int64_t minn() const { return ceil(gamma * (a.maxn() - a.size) + delta * W); }
   int64_t maxn() const { return floor(gamma * (a.maxn() - 1) - delta * W); }
+  // Upper bound on the number of output samples produced by pushing count
+  // input samples, i.e. the size of y required by process.
+  size_t max_output(size_t count) const { return ceil(gamma * count) + 1; }
+  // Block processing. Pushes count input samples from x and writes each
+  // output sample that becomes available to y, starting from output n which
+  // is advanced. Returns the number of samples written to y.
+  size_t process(const T *x, size_t count, T *y, int64_t &n) {
+    size_t written = 0;
+    for (size_t i = 0; i < count; i++) {
+      a.push(x[i]);
+      const int64_t last = maxn();
+      while (n <= last) y[written++] = (*this)(n++);
+    }
+    return written;
+  }
 
  protected:
   CircularBuffer<T> a;
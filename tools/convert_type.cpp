@@ -16,6 +16,9 @@
 #include <stdlib.h>
 #include "tools/cmdline.h"
 
+// maximum number of samples converted per block
+static const size_t block_size = 1 << 16;
+
 int main(int argc, char **argv) {
   cmdline::parser cmd_parser;
 
@@ -41,24 +44,24 @@ int main(int argc, char **argv) {
   const std::string output_type = cmd_parser.get<std::string>("to");
   const bool exit_on_clip = cmd_parser.exist("exit-on-clip");
 
-  // assign function to read samples from file
-  bool (*read_sample)(FILE * stdin, complex & sample);
+  // assign function to read blocks of samples from file
+  size_t (*read_samples)(FILE *, complex *, size_t);
   if (input_type == "double")
-    read_sample = read_sample_of_type<double>;
+    read_samples = read_samples_of_type<double>;
   else if (input_type == "float")
-    read_sample = read_sample_of_type<float>;
+    read_samples = read_samples_of_type<float>;
   else if (input_type == "uint8")
-    read_sample = read_sample_of_type<uint8_t>;
+    read_samples = read_samples_of_type<uint8_t>;
   else if (input_type == "int8")
-    read_sample = read_sample_of_type<int8_t>;
+    read_samples = read_samples_of_type<int8_t>;
   else if (input_type == "int16")
-    read_sample = read_sample_of_type<int16_t>;
+    read_samples = read_samples_of_type<int16_t>;
   else if (input_type == "uint16")
-    read_sample = read_sample_of_type<uint16_t>;
+    read_samples = read_samples_of_type<uint16_t>;
   else if (input_type == "int32")
-    read_sample = read_sample_of_type<int32_t>;
+    read_samples = read_samples_of_type<int32_t>;
   else if (input_type == "txt")
-    read_sample = read_sample_txt;
+    read_samples = read_samples_txt;
   else {
     std::cerr << "Input type must be one of double, float, uint8, int8, int16, "
                  "uint16, or int32"
@@ -67,24 +70,24 @@ int main(int argc, char **argv) {
     return EXIT_FAILURE;
   }
 
-  // assign function to write sample to stdout
-  bool (*print_sample)(FILE *, const complex);
+  // assign function to write blocks of samples to stdout
+  bool (*print_samples)(FILE *, const complex *, size_t, bool);
   if (output_type == "double")
-    print_sample = print_sample_of_type<double>;
+    print_samples = print_samples_of_type<double>;
   else if (output_type == "float")
-    print_sample = print_sample_of_type<float>;
+    print_samples = print_samples_of_type<float>;
   else if (output_type == "uint8")
-    print_sample = print_sample_of_type<uint8_t>;
+    print_samples = print_samples_of_type<uint8_t>;
   else if (output_type == "int8")
-    print_sample = print_sample_of_type<int8_t>;
+    print_samples = print_samples_of_type<int8_t>;
   else if (output_type == "int16")
-    print_sample = print_sample_of_type<int16_t>;
+    print_samples = print_samples_of_type<int16_t>;
   else if (output_type == "uint16")
-    print_sample = print_sample_of_type<uint16_t>;
+    print_samples = print_samples_of_type<uint16_t>;
   else if (output_type == "int32")
-    print_sample = print_sample_of_type<int32_t>;
+    print_samples = print_samples_of_type<int32_t>;
   else if (output_type == "txt")
-    print_sample = print_sample_txt;
+    print_samples = print_samples_txt;
   else {
     std::cerr
         << "Output type must be one of double, float, int8, int16, uint16, or "
@@ -94,11 +97,15 @@ int main(int argc, char **argv) {
     return EXIT_FAILURE;
   }
 
-  // the actual conversion loop
-  complex sample;
-  while (read_sample(stdin, sample)) {
-    const bool clipped = print_sample(stdout, sample);
+  // the actual conversion loop, a block of samples at a time
+  std::vector<complex> samples(block_size);
+  size_t count;
+  while ((count = read_samples(stdin, samples.data(), block_size)) > 0) {
+    const bool clipped =
+        print_samples(stdout, samples.data(), count, exit_on_clip);
     if (exit_on_clip && clipped) return EXIT_FAILURE;
+    // pass samples on as they arrive rather than in stdio buffer sized bursts
+    fflush(stdout);
   }
 
   return EXIT_SUCCESS;
@@ -18,6 +18,8 @@
 #include <complex>
 #include <limits>
 #include <string>
+#include <vector>
+#include "tools/stream_io.h"
 
 typedef std::complex<double> complex;
 
@@ -40,6 +42,18 @@ bool read_sample_of_type(FILE *infile, complex &sample) {
   return true;
 }
 
+// read up to count complex samples of templated type from input file into
+// samples, as many as are available, returns the number of samples read
+template <typename T>
+size_t read_samples_of_type(FILE *infile, complex *samples, size_t count) {
+  const double off = offset<T>();
+  std::vector<T> buf(2 * count);
+  const size_t n = read_available(infile, buf.data(), 2 * sizeof(T), count);
+  for (size_t i = 0; i < n; i++)
+    samples[i] = complex(buf[2 * i] - off, buf[2 * i + 1] - off);
+  return n;
+}
+
 // saturation
 template <typename T>
 double limit(double x, bool &clipped) {
@@ -65,6 +79,13 @@ bool read_sample_txt(FILE *infile, complex &sample) {
   return true;
 }
 
+// read up to count samples in txt format
+size_t read_samples_txt(FILE *infile, complex *samples, size_t count) {
+  size_t n = 0;
+  while (n < count && read_sample_txt(infile, samples[n])) n++;
+  return n;
+}
+
 // print sample to a line in txt format, complex and imaginary parts tab
 // seperated.
 bool print_sample_txt(FILE *file, const complex sample) {
@@ -84,4 +105,37 @@ bool print_sample_of_type(FILE *file, const complex sample) {
   return clipped;
 }
 
+// print count samples in txt format
+bool print_samples_txt(FILE *file, const complex *samples, size_t count,
+                       bool stop_on_clip) {
+  for (size_t i = 0; i < count; i++) print_sample_txt(file, samples[i]);
+  return false;  // never clip
+}
+
+// cast count complex samples to templated type and write them to file in a
+// single block. Returns true if any sample clipped, in which case writing
+// stops after the first clipped sample if stop_on_clip.
+template <typename T>
+bool print_samples_of_type(FILE *file, const complex *samples, size_t count,
+                           bool stop_on_clip) {
+  const double off = offset<T>();
+  std::vector<T> buf(2 * count);
+  bool any_clipped = false;
+  size_t n = 0;
+  while (n < count) {
+    bool clipped_re, clipped_im;
+    buf[2 * n] =
+        static_cast<T>(limit<T>(std::real(samples[n]) + off, clipped_re));
+    buf[2 * n + 1] =
+        static_cast<T>(limit<T>(std::imag(samples[n]) + off, clipped_im));
+    n++;
+    if (clipped_re || clipped_im) {
+      any_clipped = true;
+      if (stop_on_clip) break;
+    }
+  }
+  fwrite(buf.data(), sizeof(T), 2 * n, file);
+  return any_clipped;
+}
+
 #endif
@@ -15,6 +15,12 @@
 
 
 from __future__ import print_function
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, OrderedDict
+import calendar
+import csv
+import json
+import os
 import sys
 import struct
 import time
@@ -24,6 +30,9 @@ import argparse
 import binascii
 import signal
 
+# os.replace is only available in Python 3, rename also replaces on POSIX
+replace_file = getattr(os, "replace", os.rename)
+
 errors = {
     0: "Internal test",
     1: "Factory reset",
@@ -150,93 +159,542 @@ def detect_port():
 
 
 def dump_bytes(bytes):
-    for b in bytes:
+    for b in bytearray(bytes):
         print("%02x" % b, end=" ")
     print("")
 
 
-# Read number of bytes rounded to 4, and dump if readback is too short
-def read_and_check_completion(file, length):
-    # Round to 4 bytes boundary
-    bytes = bytearray(file.read(int((length + 3) // 4 * 4)))
-    if len(bytes) < length:
-        print("Incomplete log payload")
-        dump_bytes(bytes)
-        return None
+# Decoded log entry. fields maps the names in contents to decoded values, and
+# is None if the payload was not decoded, in which case payload holds its
+# bytes. error is None or one of the INCOMPLETE_ENTRY, INCOMPLETE_PAYLOAD and
+# UNDECODABLE messages.
+LogEntry = namedtuple(
+    "LogEntry", ["timestamp", "code", "name", "length", "fields", "payload", "error"]
+)
+
+INCOMPLETE_ENTRY = "Incomplete log entry"
+INCOMPLETE_PAYLOAD = "Incomplete log payload"
+UNDECODABLE = "Unable to decode"
+
+# Entry format, in little endian
+# |0-3|4-5|6-7|8-?|
+# |Timestamp|Length|Code|Payload|
+entry_header = struct.Struct("<IHH")
+entry_structs = dict(
+    (code, struct.Struct(unpack_strings[name]))
+    for code, name in errors.items()
+    if name in unpack_strings
+)
+
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+
+def is_user_code(code):
+    return code >= 0x80 and code <= 0x80 + 0xFF
+
+
+def decode_payload(code, length, payload):
+    """Returns name, fields and error of an entry's payload"""
+    name = errors.get(code)
+    s = entry_structs.get(code)
+    if length == 0 and name is not None:
+        return name, None, None
+    if s is not None and s.size == len(payload):
+        return name, OrderedDict(zip(contents[name], s.unpack(payload))), None
+    if is_user_code(code):
+        return "User error code %d" % (code - 0x80), None, None
+    if name is not None:
+        return name, None, UNDECODABLE
+    return "Unknown error code %d" % code, None, None
+
+
+def decode_stream(stream, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Generator of LogEntry decoded from the binary log stream, which is read in
+    chunks of chunk_size bytes.
+    """
+    buf = b""
+    pos = 0
+    eof = False
+    while True:
+        # Refill so that at least one header is buffered
+        while len(buf) - pos < entry_header.size and not eof:
+            chunk = stream.read(chunk_size)
+            eof = len(chunk) == 0
+            buf = buf[pos:] + chunk
+            pos = 0
+        if pos == len(buf):
+            return
+        if len(buf) - pos < entry_header.size:
+            yield LogEntry(None, None, None, 0, None, buf[pos:], INCOMPLETE_ENTRY)
+            return
+        timestamp, length, code = entry_header.unpack_from(buf, pos)
+        # End of the log
+        if timestamp == 0xFFFFFFFF:
+            return
+        # Payloads are padded to 4 bytes boundary
+        end = pos + entry_header.size + (length + 3) // 4 * 4
+        while len(buf) < end and not eof:
+            chunk = stream.read(chunk_size)
+            eof = len(chunk) == 0
+            buf = buf[pos:] + chunk
+            end -= pos
+            pos = 0
+        payload = buf[pos + entry_header.size : end]
+        if len(payload) < length:
+            name = decode_payload(code, 0, b"")[0]
+            yield LogEntry(
+                timestamp, code, name, length, None, payload, INCOMPLETE_PAYLOAD
+            )
+            return
+        name, fields, error = decode_payload(code, length, payload)
+        yield LogEntry(timestamp, code, name, length, fields, payload, error)
+        pos = end
+
+
+def iter_log(logfile, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Generator of LogEntry decoded from the binary log file logfile"""
+    with open(logfile, "rb") as binary_file:
+        for entry in decode_stream(binary_file, chunk_size):
+            yield entry
+
+
+def entry_time(entry):
+    # UTC time
+    return time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(float(entry.timestamp)))
+
+
+def print_log(entries):
+    """Prints entries in human readable form. Returns True if there were none"""
+    is_empty = True
+    for entry in entries:
+        if entry.error == INCOMPLETE_ENTRY:
+            if not is_empty:
+                print(INCOMPLETE_ENTRY)
+            break
+        is_empty = False
+        print_entry(entry)
+    return is_empty
+
+
+def print_entry(entry, module=None):
+    """Prints entry in human readable form, labelled with module if given"""
+    # Entries with unknown codes are only shown with a payload
+    if entry.code not in errors and not is_user_code(entry.code):
+        if entry.length == 0:
+            return
+    if module is None:
+        print("====%s %s====" % (entry_time(entry), entry.name))
     else:
-        return bytes
+        print("====%s [%s] %s====" % (entry_time(entry), module, entry.name))
+    if entry.error is not None:
+        print(entry.error)
+        dump_bytes(entry.payload)
+    elif entry.fields is not None:
+        for k, v in entry.fields.items():
+            print("%s : 0x%08x(%d)" % (k, v, v))
+        if entry.name == "Reset reason":
+            print("%s" % reset_reasons.get(entry.fields["Reset reason"], "Unknown"))
+    elif entry.length != 0:
+        dump_bytes(entry.payload)
+
+
+def entry_dict(entry):
+    """Returns entry as a dictionary suitable for JSON serialisation"""
+    d = OrderedDict(
+        [
+            ("timestamp", entry.timestamp),
+            ("time", None if entry.timestamp is None else entry_time(entry)),
+            ("code", entry.code),
+            ("name", entry.name),
+            ("length", entry.length),
+            ("fields", entry.fields),
+            ("payload", None),
+            ("error", entry.error),
+        ]
+    )
+    if entry.fields is None and entry.payload:
+        d["payload"] = binascii.hexlify(entry.payload).decode("ascii")
+    return d
+
+
+def annotated_dict(item):
+    # entries from batch decoding come as (timestamp, module, logfile, entry)
+    if isinstance(item, LogEntry):
+        return entry_dict(item)
+    _, module, logfile, entry = item
+    d = OrderedDict([("module", module), ("file", logfile)])
+    d.update(entry_dict(entry))
+    return d
+
+
+def write_jsonl(entries, out=sys.stdout):
+    """Writes entries as JSON Lines"""
+    for entry in entries:
+        out.write(json.dumps(annotated_dict(entry)) + "\n")
+
+
+def write_csv(entries, out=sys.stdout):
+    """Writes entries as CSV, with decoded fields as a JSON object column"""
+    writer = csv.writer(out)
+    columns = None
+    for entry in entries:
+        d = annotated_dict(entry)
+        if d["fields"] is not None:
+            d["fields"] = json.dumps(d["fields"])
+        if columns is None:
+            columns = list(d.keys())
+            writer.writerow(columns)
+        writer.writerow([d[c] for c in columns])
+
+
+output_formats = {
+    "jsonl": write_jsonl,
+    "csv": write_csv,
+}
 
 
 def decode_log(logfile):
-    with open(logfile, "rb") as binary_file:
-        # Entry format, in little endian
-        # |0-1|2-3|4-?|
-        # |Length|Code|Payload|
-        is_empty = True
-        while True:
-            bytes = binary_file.read(8)
-            if len(bytes) == 0:
-                is_empty = False
-                return is_empty
-            if len(bytes) < 8:
-                if not is_empty:
-                    print("Incomplete log entry")
-                binary_file.close()
-                return is_empty
-            timestamp = struct.unpack("<IHH", bytes)
-            timestamp, length, code = struct.unpack("<IHH", bytes)
-            # End of the log
-            if timestamp == 0xFFFFFFFF:
-                return is_empty
-            is_empty = False
-            # UTC time
-            time_string = time.strftime(
-                "%Y-%m-%d %H:%M:%S UTC", time.gmtime(float(timestamp))
+    return print_log(iter_log(logfile))
+
+
+def find_logs(directory, extension=".bin"):
+    """Returns the paths of all files with extension in the directory tree"""
+    logs = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(extension):
+                logs.append(os.path.join(root, name))
+    return logs
+
+
+def decode_log_entries(logfile):
+    """Decodes logfile into a list of entries sorted by time"""
+    entries = [e for e in iter_log(logfile) if e.timestamp is not None]
+    entries.sort(key=lambda e: e.timestamp)
+    return logfile, entries
+
+
+def log_module_id(entries):
+    for entry in entries:
+        if entry.name == "Module ID" and entry.fields is not None:
+            return "%08x" % entry.fields["Module ID"]
+    return None
+
+
+class LogStats(object):
+    """Aggregate statistics over the entries of many logs"""
+
+    def __init__(self):
+        self.logs = 0
+        self.entries = 0
+        self.modules = {}
+        self.watchdog_resets = {}
+
+    def add_log(self, logfile, module, entries):
+        self.logs += 1
+        self.entries += len(entries)
+        stats = self.modules.setdefault(
+            module,
+            {"logs": [], "entries": 0, "reset_reasons": {}, "watchdog_resets": {}},
+        )
+        stats["logs"].append(logfile)
+        stats["entries"] += len(entries)
+        for entry in entries:
+            if entry.fields is None:
+                continue
+            if entry.name == "Reset reason":
+                reason = entry.fields["Reset reason"]
+                reason = reset_reasons.get(reason, "Unknown (%d)" % reason)
+                stats["reset_reasons"][reason] = (
+                    stats["reset_reasons"].get(reason, 0) + 1
+                )
+            elif entry.name == "Watchdog reset":
+                job = str(entry.fields["Job ID"])
+                stats["watchdog_resets"][job] = stats["watchdog_resets"].get(job, 0) + 1
+                self.watchdog_resets[job] = self.watchdog_resets.get(job, 0) + 1
+
+    def summary(self):
+        return OrderedDict(
+            [
+                ("logs", self.logs),
+                ("entries", self.entries),
+                ("watchdog_resets_per_job", self.watchdog_resets),
+                ("modules", self.modules),
+            ]
+        )
+
+
+def merge_streams(streams):
+    """
+    Generator merging lists of entries sorted by time into one, taking entries
+    with equal times in stream order, as heapq.merge with a key in Python 3
+    """
+    import heapq
+
+    heap = [(stream[0][0], i, 0) for i, stream in enumerate(streams) if stream]
+    heapq.heapify(heap)
+    while heap:
+        _, i, j = heapq.heappop(heap)
+        yield streams[i][j]
+        if j + 1 < len(streams[i]):
+            heapq.heappush(heap, (streams[i][j + 1][0], i, j + 1))
+
+
+def decode_batch(directory, output_format="jsonl", jobs=None, stats_file=None):
+    """
+    Decodes every log in the directory tree in parallel and writes one time
+    ordered stream of entries annotated with module ID and log file, followed
+    by aggregate statistics. Returns False if no log was found.
+    """
+    from multiprocessing import Pool
+
+    logs = find_logs(directory)
+    if not logs:
+        return False
+    stats = LogStats()
+    streams = []
+    pool = Pool(jobs)
+    try:
+        for logfile, entries in pool.imap(
+            decode_log_entries, logs, chunksize=max(1, len(logs) // 64)
+        ):
+            module = log_module_id(entries)
+            stats.add_log(logfile, module, entries)
+            streams.append([(e.timestamp, module, logfile, e) for e in entries])
+    finally:
+        pool.close()
+        pool.join()
+
+    merged = merge_streams(streams)
+    if output_format == "text":
+        for _, module, logfile, entry in merged:
+            print_entry(entry, module or logfile)
+    else:
+        output_formats[output_format](merged)
+
+    summary = json.dumps(stats.summary(), indent=2)
+    if stats_file is None:
+        sys.stderr.write(summary + "\n")
+    else:
+        with open(stats_file, "w") as f:
+            f.write(summary + "\n")
+    return True
+
+
+def scan_log(data):
+    """
+    Returns offset, timestamp, length and code of the complete entries in the
+    log buffer data, up to the end of log marker
+    """
+    view = memoryview(data)
+    entries = []
+    pos = 0
+    while len(view) - pos >= entry_header.size:
+        timestamp, length, code = entry_header.unpack_from(view, pos)
+        if timestamp == 0xFFFFFFFF:
+            break
+        end = pos + entry_header.size + (length + 3) // 4 * 4
+        if end > len(view):
+            break
+        entries.append((pos, timestamp, length, code))
+        pos = end
+    return entries
+
+
+def entry_dtype(name):
+    """NumPy structured dtype equivalent to the unpack string of entry name"""
+    import numpy
+
+    fmt = unpack_strings[name]
+    return numpy.dtype(
+        [(field, fmt[0] + c) for field, c in zip(contents[name], fmt[1:])]
+    )
+
+
+def log_columns(logfile):
+    """
+    Decodes logfile into columns, a dictionary of NumPy arrays. Entries of each
+    code with a known payload layout are decoded together as structured arrays.
+    """
+    import numpy
+
+    raw = numpy.fromfile(logfile, dtype=numpy.uint8)
+    scanned = numpy.array(scan_log(raw), dtype=numpy.int64).reshape(-1, 4)
+    offsets, timestamps, lengths, codes = scanned.T
+    columns = {
+        "entries.timestamp": timestamps.astype(numpy.uint32),
+        "entries.length": lengths.astype(numpy.uint16),
+        "entries.code": codes.astype(numpy.uint16),
+    }
+    padded = (lengths + 3) // 4 * 4
+    for code, name in errors.items():
+        if name not in unpack_strings:
+            continue
+        dtype = entry_dtype(name)
+        selected = (codes == code) & (padded == dtype.itemsize)
+        start = offsets[selected] + entry_header.size
+        # gather the payloads of all selected entries, then reinterpret
+        index = start[:, None] + numpy.arange(dtype.itemsize)
+        records = raw[index].view(dtype).reshape(-1)
+        columns["%s.timestamp" % name] = timestamps[selected].astype(numpy.uint32)
+        for field in dtype.names:
+            columns["%s.%s" % (name, field)] = records[field]
+    return columns
+
+
+def export_columnar(logfiles, output):
+    """
+    Writes the decoded entries of logfiles as columns to output, a NumPy .npz
+    file or otherwise a directory of Arrow IPC files, one per entry type.
+    Entries are tagged with the module ID of their log.
+    """
+    import numpy
+
+    merged = {}
+    for logfile in logfiles:
+        columns = log_columns(logfile)
+        module_ids = columns.get("Module ID.Module ID", [])
+        module_id = module_ids[0] if len(module_ids) else 0
+        for key, column in columns.items():
+            table = key.rsplit(".", 1)[0]
+            merged.setdefault(table + ".module", {})[logfile] = numpy.full(
+                len(column), module_id, dtype=numpy.uint32
             )
-            try:
-                key = errors[code]
-                if length == 0:
-                    print("====%s %s====" % (time_string, key))
-                    continue
-                else:
-                    bytes = read_and_check_completion(binary_file, length)
-                    if bytes is None:
-                        print("====%s %s====" % (time_string, key))
-                        return is_empty
-                    else:
-                        values = struct.unpack(unpack_strings[key], bytes)
-                        print("====%s %s====" % (time_string, key))
-                        for k, v in zip(contents[key], values):
-                            print("%s : 0x%08x(%d)" % (k, v, v))
-                        if key == "Reset reason":
-                            print("%s" % reset_reasons[values[0]])
-                        continue
-            except struct.error:
-                if code < 0x80:
-                    print("====%s %s====" % (time_string, key))
-                    print("Unable to decode")
-                    dump_bytes(bytes)
-                    continue
-                else:
-                    binary_file.seek(-len(bytes), 1)
-            except KeyError:
-                pass
-            if code >= 0x80 and code <= 0x80 + 0xFF:
-                print("====%s User error code %d====" % (time_string, (code - 0x80)))
-                if length != 0:
-                    bytes = read_and_check_completion(binary_file, length)
-                    if bytes is None:
-                        return is_empty
-                    else:
-                        dump_bytes(bytes)
-                        continue
-            if length != 0:
-                print("====%s Unknown error code %d====" % (time_string, code))
-                bytes = read_and_check_completion(binary_file, length)
-                if bytes is None:
-                    return is_empty
-                else:
-                    dump_bytes(bytes)
+            merged.setdefault(key, {})[logfile] = column
+    columns = dict(
+        (key, numpy.concatenate([parts[f] for f in logfiles if f in parts]))
+        for key, parts in merged.items()
+    )
+    if output.endswith(".npz"):
+        numpy.savez_compressed(output, **columns)
+        return
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        sys.exit("pyarrow is required for Arrow IPC output, or use a .npz FILE")
+    tables = {}
+    for key, column in columns.items():
+        table, field = key.rsplit(".", 1)
+        tables.setdefault(table, []).append((field, pyarrow.array(column)))
+    if not os.path.exists(output):
+        os.makedirs(output)
+    for table, fields in tables.items():
+        batch = pyarrow.RecordBatch.from_arrays(
+            [c for _, c in fields], names=[f for f, _ in fields]
+        )
+        with pyarrow.OSFile(os.path.join(output, table + ".arrow"), "wb") as sink:
+            with pyarrow.ipc.new_file(sink, batch.schema) as writer:
+                writer.write_batch(batch)
+
+
+INDEX_VERSION = 1
+
+
+def index_file(logfile):
+    return logfile + ".idx"
+
+
+def build_index(logfile):
+    """
+    Builds the index of logfile, which maps each code to the timestamps and
+    byte offsets of its entries sorted by time, and writes it next to the log.
+    """
+    with open(logfile, "rb") as binary_file:
+        data = binary_file.read()
+    entries = {}
+    for offset, timestamp, length, code in scan_log(data):
+        entries.setdefault(str(code), []).append((timestamp, offset))
+    codes = {}
+    for code, e in entries.items():
+        e.sort()
+        codes[code] = {
+            "timestamps": [timestamp for timestamp, _ in e],
+            "offsets": [offset for _, offset in e],
+        }
+    st = os.stat(logfile)
+    index = {
+        "version": INDEX_VERSION,
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "codes": codes,
+    }
+    try:
+        with open(index_file(logfile) + ".tmp", "w") as f:
+            json.dump(index, f)
+        replace_file(index_file(logfile) + ".tmp", index_file(logfile))
+    except (IOError, OSError):
+        # a read-only archive can still be queried, just without caching
+        pass
+    return index
+
+
+def load_index(logfile):
+    """Returns the index of logfile, rebuilding it if missing or stale"""
+    try:
+        with open(index_file(logfile), "r") as f:
+            index = json.load(f)
+        st = os.stat(logfile)
+        if (
+            index["version"] == INDEX_VERSION
+            and index["size"] == st.st_size
+            and index["mtime"] == st.st_mtime
+        ):
+            return index
+    except (IOError, ValueError, KeyError):
+        pass
+    return build_index(logfile)
+
+
+def query_log(logfile, codes=None, start=None, end=None, last=None):
+    """
+    Generator of the LogEntry of logfile with a code in codes, all if None,
+    and a timestamp between start and end inclusive, in time order. Only the
+    last entries are returned if last is given. Entries are read by seeking
+    to their offsets in the index.
+    """
+    index = load_index(logfile)
+    hits = []
+    for code, entries in index["codes"].items():
+        if codes is not None and int(code) not in codes:
+            continue
+        timestamps = entries["timestamps"]
+        lo = 0 if start is None else bisect_left(timestamps, start)
+        hi = len(timestamps) if end is None else bisect_right(timestamps, end)
+        hits.extend(zip(timestamps[lo:hi], entries["offsets"][lo:hi]))
+    hits.sort()
+    if last:
+        hits = hits[-last:]
+    with open(logfile, "rb") as binary_file:
+        for _, offset in hits:
+            binary_file.seek(offset)
+            for entry in decode_stream(binary_file, 512):
+                yield entry
+                break
+
+
+def parse_code(value):
+    """Returns the code of an entry given by number or name"""
+    if value.isdigit():
+        return int(value)
+    for code, name in errors.items():
+        if name.lower() == value.lower():
+            return code
+    raise argparse.ArgumentTypeError("unknown log entry %s" % value)
+
+
+def parse_time(value):
+    """Returns Unix epoch seconds of value given as such or as UTC date/time"""
+    if value.isdigit():
+        return int(value)
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid time %s" % value)
 
 
 def capture_bootloader(portname, baudrate, wait_flag):
@@ -303,18 +761,106 @@ def capture_bootloader(portname, baudrate, wait_flag):
     return ser
 
 
-def read_log(ser):
+class LogEndDetector(object):
+    """Follows entry boundaries of a log as it arrives to spot its end"""
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.skip = 0
+
+    def feed(self, data):
+        """Returns True once the end of log marker has been fed"""
+        self.buf += data
+        while True:
+            if self.skip:
+                n = min(self.skip, len(self.buf))
+                del self.buf[:n]
+                self.skip -= n
+                if self.skip:
+                    return False
+            if len(self.buf) < entry_header.size:
+                return False
+            timestamp, length, code = entry_header.unpack_from(self.buf)
+            if timestamp == 0xFFFFFFFF:
+                return True
+            self.skip = entry_header.size + (length + 3) // 4 * 4
+
+
+def read_log(ser, binary_file):
+    """
+    Dumps the log from the bootloader on ser and writes it to binary_file as
+    it arrives. Returns the number of bytes written.
+    """
     print("Start reading the log")
     # Start dumping
     ser.write(b"x")
-    dump = b""
+    dump = bytearray()
+    end = LogEndDetector()
+    size = 0
     while True:
         out = ser.readline()
         if len(out) > 16:
             dump += out.strip()
+            # decode whole bytes, keep any odd hex digit for the next line
+            n = len(dump) & ~1
+            data = binascii.unhexlify(bytes(dump[:n]))
+            del dump[:n]
+            binary_file.write(data)
+            size += len(data)
+            # stop at the end of log marker instead of waiting for a timeout
+            if end.feed(data):
+                break
         elif len(out) == 0:
             break
-    return dump
+    return size
+
+
+BAUD_RATES = [921600, 460800, 230400, 115200]
+
+
+def probe_baudrate(portname, rates=BAUD_RATES):
+    """
+    Returns the highest of rates at which the bootloader on portname, which
+    must already be captured, responds.
+    """
+    for rate in rates:
+        try:
+            ser = serial.Serial(
+                port=portname,
+                baudrate=rate,
+                parity=serial.PARITY_NONE,
+                stopbits=serial.STOPBITS_ONE,
+                bytesize=serial.EIGHTBITS,
+                xonxoff=0,
+                rtscts=0,
+                timeout=0.5,
+            )
+        except (OSError, serial.SerialException):
+            break
+        try:
+            ser.reset_input_buffer()
+            ser.write(b"U")
+            ser.flush()
+            out = ser.readline()
+            out += ser.readline()
+        finally:
+            ser.close()
+        if b"Bootloader" in out or b"Unknown" in out:
+            return rate
+    return rates[-1]
+
+
+def open_bootloader(portname, baudrate, wait_flag):
+    """
+    capture_bootloader at baudrate, or at the highest rate the bootloader
+    accepts if baudrate is "max"
+    """
+    if str(baudrate) != "max":
+        return capture_bootloader(portname, baudrate, wait_flag), baudrate
+    ser = capture_bootloader(portname, BAUD_RATES[-1], wait_flag)
+    ser.close()
+    baudrate = probe_baudrate(portname)
+    return capture_bootloader(portname, baudrate, False), baudrate
 
 
 def purge_log(ser):
@@ -360,6 +906,71 @@ def main():
     parser.add_argument(
         "-i", "--ifile", dest="infile", help="decode local log FILE", metavar="FILE"
     )
+    parser.add_argument(
+        "--batch",
+        dest="batch_dir",
+        metavar="DIR",
+        help="decode all .bin logs in the DIR tree in parallel into one time ordered stream",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of processes decoding logs in batch mode, all cores by default",
+    )
+    parser.add_argument(
+        "--stats",
+        dest="stats_file",
+        metavar="FILE",
+        help="write batch mode statistics to FILE instead of stderr",
+    )
+    parser.add_argument(
+        "--columnar",
+        dest="columnar_output",
+        metavar="FILE",
+        help="export decoded entries as columns to a NumPy .npz FILE, or to a "
+        "directory FILE of Arrow IPC files",
+    )
+    parser.add_argument(
+        "-c",
+        "--code",
+        dest="query_codes",
+        type=parse_code,
+        action="append",
+        metavar="CODE",
+        help="only show entries of CODE, a number or name such as 'Watchdog reset', "
+        "can have multiple",
+    )
+    parser.add_argument(
+        "--from",
+        dest="query_from",
+        type=parse_time,
+        metavar="TIME",
+        help="only show entries from TIME, Unix epoch seconds or UTC 'YYYY-MM-DD HH:MM:SS'",
+    )
+    parser.add_argument(
+        "--to",
+        dest="query_to",
+        type=parse_time,
+        metavar="TIME",
+        help="only show entries up to TIME",
+    )
+    parser.add_argument(
+        "--last",
+        dest="query_last",
+        type=int,
+        metavar="N",
+        help="only show the last N matching entries",
+    )
+    parser.add_argument(
+        "-F",
+        "--format",
+        dest="output_format",
+        choices=["text"] + sorted(output_formats),
+        default="text",
+        help="decoded log output format",
+    )
     parser.add_argument(
         "-o",
         "--ofile",
@@ -398,7 +1009,7 @@ def main():
         dest="baud_rate",
         metavar="BAUDRATE",
         default=115200,
-        help="set the serial port BAUDRATE",
+        help="set the serial port BAUDRATE, or max for the highest the bootloader accepts",
     )
 
     parser.add_argument(
@@ -412,6 +1023,21 @@ def main():
 
     args = parser.parse_args()
 
+    if args.batch_dir and args.columnar_output:
+        logs = find_logs(args.batch_dir)
+        if not logs:
+            print("No log found")
+        else:
+            export_columnar(logs, args.columnar_output)
+        sys.exit(0)
+
+    if args.batch_dir:
+        if not decode_batch(
+            args.batch_dir, args.output_format, args.jobs, args.stats_file
+        ):
+            print("No log found")
+        sys.exit(0)
+
     port_name = args.portname
     if args.default_port_flag:
         if serial.tools.list_ports.comports():
@@ -432,7 +1058,7 @@ def main():
 
     if args.purge_flag:
         if serial_port is None:
-            serial_port = capture_bootloader(port_name, args.baud_rate, args.wait_flag)
+            serial_port, _ = open_bootloader(port_name, args.baud_rate, args.wait_flag)
         answer = ""
         while answer not in ["y", "n"]:
             answer = input("Do you want to purge the log [y/n]? ").lower()
@@ -444,16 +1070,33 @@ def main():
     if not infile:
         if port_name != "None":
             print("Using serial port", port_name, args.baud_rate)
-            serial_port = capture_bootloader(port_name, args.baud_rate, args.wait_flag)
-            dump = read_log(serial_port)
+            serial_port, baud_rate = open_bootloader(
+                port_name, args.baud_rate, args.wait_flag
+            )
+            if baud_rate != args.baud_rate:
+                print("Using baudrate", baud_rate)
             print("Writing log to", outfile)
             with open(outfile, "wb") as binary_file:
-                binary_file.write(binascii.unhexlify(dump))
-                binary_file.close()
+                read_log(serial_port, binary_file)
+            build_index(outfile)
             infile = outfile
-    print("Decoding", infile)
-    if decode_log(infile):
-        print("No log found")
+    query = [args.query_codes, args.query_from, args.query_to, args.query_last]
+    if any(q is not None for q in query):
+        # seek to matching entries through the index instead of decoding it all
+        entries = query_log(infile, *query)
+        if args.output_format == "text":
+            for entry in entries:
+                print_entry(entry)
+        else:
+            output_formats[args.output_format](entries)
+    elif args.columnar_output:
+        export_columnar([infile], args.columnar_output)
+    elif args.output_format == "text":
+        print("Decoding", infile)
+        if decode_log(infile):
+            print("No log found")
+    else:
+        output_formats[args.output_format](iter_log(infile))
 
     if serial_port is not None:
         serial_port.close()
@@ -17,6 +17,7 @@
 from __future__ import print_function
 import argparse
 import binascii
+import myriota_crc
 import os
 import shutil
 import signal
@@ -37,28 +38,6 @@ header_length = (
 header_version = 0
 
 
-def _bytecrc(crc, poly, n):
-    mask = 1 << (n - 1)
-    for i in range(8):
-        if crc & mask:
-            crc = (crc << 1) ^ poly
-        else:
-            crc = crc << 1
-    mask = (1 << n) - 1
-    crc = crc & mask
-    return crc
-
-
-def calc_crc(data):
-    poly = 0x11021
-    bit_size = 16
-    table = [_bytecrc(i << (bit_size - 8), poly, bit_size) for i in range(256)]
-    crc = 0
-    for b in data:
-        crc = table[b ^ ((crc >> 8) & 0xFF)] ^ ((crc << 8) & 0xFF00)
-    return crc
-
-
 def list_file(filename):
     try:
         print("List files from", filename, "\n")
@@ -89,7 +68,7 @@ def list_file(filename):
                 input_file.seek(0 - header_length, os.SEEK_CUR)
                 data = bytearray(input_file.read(header_length + flen))
                 data[14] = data[15] = 0
-                if checksum != (calc_crc(data) & 0xFFFF):
+                if checksum != myriota_crc.crc16(data):
                     sys.stderr.write("Failed to verify file\n")
                     sys.exit(1)
 
@@ -119,7 +98,7 @@ def append_file(infile, outfile, type):
                 outfile.write(input_file.read(input_size))
                 outfile.seek(0 - input_size - header_length, os.SEEK_CUR)
                 data = bytearray(outfile.read(input_size + header_length))
-                checksum = calc_crc(data) & 0xFFFF
+                checksum = myriota_crc.crc16(data)
                 outfile.seek(14 - input_size - header_length, os.SEEK_CUR)
                 outfile.write(struct.pack("<H", checksum))
             except IOError:
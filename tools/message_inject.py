@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # Copyright (c) 2016-2020, Myriota Pty Ltd, All Rights Reserved
 # SPDX-License-Identifier: BSD-3-Clause-Attribution
@@ -13,44 +13,343 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import print_function
+import sys
+
+if sys.version_info[0] < 3:
+    sys.exit("message_inject.py requires Python 3")
 
 import myriota_auth
+import message_store
+from myriota_http import http_session
 from datetime import datetime
+import binascii
+import bisect
+import collections
+import concurrent.futures
 import json
+import random
 import requests
-import sys
+import struct
+import threading
 import time
 
 _domain = "https://api.myriota.com/v1"
 
+# message of the tracker example: sequence number, latitude and longitude in
+# 1e-7 degrees and timestamp, as unpacked by examples/tracker/unpack.py
+TRACKER_FORMAT = "<HiiI"
+
+
+class LatencyHistogram(object):
+    """Counts of latencies in buckets with 1-2-5 steps from 100 µs to 50 s"""
+
+    BOUNDS = [b * 10.0**e for e in range(-4, 2) for b in (1, 2, 5)]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """
+        Estimate of the p percentile, interpolated linearly within its bucket
+        and at most the largest latency observed, None if unobserved
+        """
+        with self.lock:
+            rank = self.count * p / 100.0
+            seen = 0
+            lower = 0.0
+            for bound, count in zip(self.BOUNDS + [self.max], self.counts):
+                if count and seen + count >= rank:
+                    upper = min(bound, self.max)
+                    return lower + (upper - lower) * (rank - seen) / count
+                seen += count
+                lower = bound
+        return None
+
+    def report(self, file=sys.stderr):
+        if not self.count:
+            return
+        print(
+            "Latency mean {:.1f}ms, p50 {:.1f}ms, p90 {:.1f}ms, p99 {:.1f}ms, "
+            "p99.9 {:.1f}ms, max {:.1f}ms".format(
+                1e3 * self.total / self.count,
+                *[1e3 * self.percentile(p) for p in (50, 90, 99, 99.9)]
+                + [1e3 * self.max]
+            ),
+            file=file,
+        )
+        lower = 0.0
+        for bound, count in zip(self.BOUNDS + [float("inf")], self.counts):
+            if count:
+                print(
+                    "  {:>8g} - {:<8g}ms {:>8} {}".format(
+                        1e3 * lower,
+                        1e3 * bound,
+                        count,
+                        "#" * int(round(50.0 * count / self.count)),
+                    ),
+                    file=file,
+                )
+            lower = bound
+
+
+class Injector(object):
+    """
+    Injects messages over a pooled HTTP session from up to workers threads,
+    with at most window messages queued or in flight. Messages of the same
+    module are injected one at a time in the order submitted, unless ordered
+    is False. Failed injections are retried when rate limited or failing,
+    and counted by cause once out of retries.
+    """
+
+    def __init__(
+        self,
+        idtoken,
+        workers=8,
+        window=64,
+        ordered=True,
+        retries=3,
+        backoff=1.0,
+        verbose=False,
+        url=None,
+    ):
+        self.idtoken = idtoken
+        self.url = url or _domain + "/messages"
+        self.session = http_session(workers)
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.window = threading.BoundedSemaphore(window)
+        self.ordered = ordered
+        self.retries = retries
+        self.backoff = backoff
+        self.verbose = verbose
+        self.token = None
+        self.token_time = 0
+        self.lock = threading.Lock()
+        # messages waiting for the message in flight of each module
+        self.queues = {}
+        self.injected = 0
+        self.failures = collections.Counter()
+        # from submission, or scheduled time if given, to injection
+        self.latency = LatencyHistogram()
+        self.start = time.time()
 
-def do_inject(idtoken, moduleid):
-    print("Injecting messages from %s..." % moduleid)
-    line = ""
-    while True:
-        ch = sys.stdin.read(1)
-        if ch == "":
-            print("Exiting...")
-            exit(0)
-        line += ch
-        if line.endswith("\n"):
-            if line.strip():
-                message = line.strip().rstrip("\n")
-                print(message)
-                data = {"TerminalId": moduleid, "Message": message}
-                headers = {
-                    "Content-type": "application/json",
-                    "Authorization": idtoken()["IdToken"],
-                }
-                url = _domain + "/messages"
+    def submit(self, moduleid, message, scheduled=None):
+        """
+        Queues message of moduleid, blocking while the window is full. The
+        latency of its injection is measured from scheduled, by default now.
+        """
+        scheduled = scheduled or time.time()
+        self.window.acquire()
+        # the token is refreshed by the submitting thread only, so workers
+        # never authenticate concurrently
+        if time.time() - self.token_time > 60:
+            self.token = self.idtoken()["IdToken"]
+            self.token_time = time.time()
+        if not self.ordered:
+            self.executor.submit(self.inject, moduleid, message, self.token, scheduled)
+            return
+        with self.lock:
+            queue = self.queues.get(moduleid)
+            if queue is not None:
+                queue.append((message, self.token, scheduled))
+                return
+            self.queues[moduleid] = collections.deque()
+        self.executor.submit(self.drain, moduleid, message, self.token, scheduled)
+
+    def drain(self, moduleid, message, token, scheduled):
+        """Injects message and then those queued behind it for moduleid"""
+        while True:
+            self.inject(moduleid, message, token, scheduled)
+            with self.lock:
+                queue = self.queues[moduleid]
+                if not queue:
+                    del self.queues[moduleid]
+                    return
+                message, token, scheduled = queue.popleft()
+
+    def inject(self, moduleid, message, token, scheduled):
+        try:
+            self.post(moduleid, message, token)
+            self.latency.observe(time.time() - scheduled)
+            with self.lock:
+                self.injected += 1
+            if self.verbose:
+                print(moduleid, message)
+        except Exception as e:
+            if isinstance(e, requests.exceptions.HTTPError):
                 try:
-                    response = requests.post(
-                        url, data=json.dumps(data), headers=headers
-                    )
-                    response.raise_for_status()
-                except requests.exceptions.RequestException as e:
-                    raise SystemExit(e.response.json())
-            line = ""
+                    error = e.response.json()
+                except ValueError:
+                    error = e.response.text
+                cause = "HTTP %d" % e.response.status_code
+            else:
+                error = e
+                cause = type(e).__name__
+            with self.lock:
+                self.failures[cause] += 1
+            print(
+                "Failed to inject {} to {}: {}".format(message, moduleid, error),
+                file=sys.stderr,
+            )
+        finally:
+            self.window.release()
+
+    def post(self, moduleid, message, token):
+        data = {"TerminalId": moduleid, "Message": message}
+        headers = {"Content-type": "application/json", "Authorization": token}
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(
+                    self.url, data=json.dumps(data), headers=headers
+                )
+                response.raise_for_status()
+                return response
+            except requests.exceptions.RequestException as e:
+                delay = message_store.retry_delay(e, attempt, self.backoff)
+                if delay is None or attempt == self.retries:
+                    raise
+                time.sleep(delay)
+
+    def wait(self):
+        """Waits for all submitted messages to be injected"""
+        self.executor.shutdown(wait=True)
+
+    def failed(self):
+        return sum(self.failures.values())
+
+    def report(self, file=sys.stderr):
+        elapsed = time.time() - self.start
+        print(
+            "Injected {} messages in {:.1f}s ({:.1f} messages/s), {} failed{}".format(
+                self.injected,
+                elapsed,
+                self.injected / max(elapsed, 1e-9),
+                self.failed(),
+                "".join(
+                    ", {} {}".format(count, cause)
+                    for cause, count in sorted(self.failures.items())
+                ),
+            ),
+            file=file,
+        )
+
+
+class VirtualTracker(object):
+    """
+    Stands in for a module running the tracker example, wandering from a
+    random position and producing its messages in hexadecimal.
+    """
+
+    def __init__(self, moduleid, rng=random):
+        self.moduleid = moduleid
+        self.rng = rng
+        self.sequence_number = 0
+        self.lat = rng.uniform(-60, 60)
+        self.lon = rng.uniform(-180, 180)
+
+    def message(self, timestamp):
+        self.lat = max(-90.0, min(90.0, self.lat + self.rng.gauss(0, 1e-3)))
+        self.lon = (self.lon + self.rng.gauss(0, 1e-3) + 180) % 360 - 180
+        data = struct.pack(
+            TRACKER_FORMAT,
+            self.sequence_number,
+            int(round(self.lat * 1e7)),
+            int(round(self.lon * 1e7)),
+            int(timestamp),
+        )
+        self.sequence_number = (self.sequence_number + 1) & 0xFFFF
+        return binascii.hexlify(data).decode()
+
+
+def do_load(idtoken, modules, rate, duration, prefix="load", seed=None, **kwargs):
+    """
+    Injects the tracker messages of modules virtual modules, rate messages
+    per second in total for duration seconds. Messages are scheduled open
+    loop at fixed intervals whatever the injection latency, and latency is
+    measured from the scheduled time, so it includes any time spent waiting
+    for the window. Returns the Injector for its counts and latencies.
+    """
+    rng = random.Random(seed)
+    trackers = [
+        VirtualTracker("{}{:04d}".format(prefix, i), rng) for i in range(modules)
+    ]
+    print(
+        "Injecting {:g} messages/s from {} virtual modules for {:g}s...".format(
+            rate, modules, duration
+        ),
+        file=sys.stderr,
+    )
+    injector = Injector(idtoken, **kwargs)
+    start = time.time()
+    late = 0
+    try:
+        for k in range(int(rate * duration)):
+            scheduled = start + k / rate
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -1e-3:
+                late += 1
+            tracker = trackers[k % modules]
+            injector.submit(tracker.moduleid, tracker.message(scheduled), scheduled)
+    finally:
+        injector.wait()
+        injector.report()
+        if late:
+            print(
+                "{} messages submitted over 1ms behind schedule".format(late),
+                file=sys.stderr,
+            )
+        injector.latency.report()
+    return injector
+
+
+def read_messages(stream, moduleid=None):
+    """
+    Generator of (moduleid, message) read from lines of stream, each line
+    a message of moduleid, or a module ID and a message if moduleid is None.
+    """
+    for line in stream:
+        fields = line.split()
+        if not fields:
+            continue
+        if moduleid is not None:
+            yield moduleid, line.strip()
+        elif len(fields) == 2:
+            yield fields[0], fields[1]
+        else:
+            print("Invalid line: {}".format(line.strip()), file=sys.stderr)
+
+
+def do_inject(idtoken, moduleid, stream=None, **kwargs):
+    """
+    Injects the messages read from lines of stream, stdin by default, as
+    received from moduleid, or from the module ID at the start of each line
+    if moduleid is None. Returns the Injector for its counts.
+    """
+    if moduleid is None:
+        print("Injecting messages...", file=sys.stderr)
+    else:
+        print("Injecting messages from %s..." % moduleid, file=sys.stderr)
+    injector = Injector(idtoken, **kwargs)
+    try:
+        for module, message in read_messages(stream or sys.stdin, moduleid):
+            injector.submit(module, message)
+    finally:
+        injector.wait()
+        injector.report()
+    return injector
 
 
 def main(argv=None):
@@ -61,21 +360,122 @@ def main(argv=None):
     import sys
 
     parser = argparse.ArgumentParser(
-        description='Command line interface for manually injecting message. Messages are input using stdin. Example: echo "1234abcd" | ./message_inject.py <moduleid>'
+        description='Command line interface for manually injecting message. Messages are input using stdin. Example: echo "1234abcd" | ./message_inject.py <moduleid>. Without a module Id, each line holds a module Id and a message separated by whitespace.'
+    )
+    parser.add_argument("moduleid", nargs="?", help="Module Id")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of concurrent requests",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=64,
+        help="Maximum number of messages queued or in flight",
+    )
+    order = parser.add_mutually_exclusive_group()
+    order.add_argument(
+        "--ordered",
+        dest="ordered",
+        action="store_true",
+        help="Inject messages of the same module one at a time, in order, the "
+        "default unless a module Id is given",
+    )
+    order.add_argument(
+        "--unordered",
+        dest="ordered",
+        action="store_false",
+        help="Inject messages of the same module concurrently, in any order, "
+        "the default when a module Id is given",
+    )
+    parser.set_defaults(ordered=None)
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Number of times a rate limited or failed injection is retried",
+    )
+    parser.add_argument(
+        "--backoff",
+        type=float,
+        default=1.0,
+        help="Seconds to wait before the first retry, doubled on each retry",
     )
-    parser.add_argument("moduleid", help="Module Id")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Print injected messages"
+    )
+    parser.add_argument(
+        "--api-url",
+        default=_domain,
+        help="API to inject messages to, such as a local stand-in",
+    )
+    parser.add_argument(
+        "--no-auth",
+        action="store_true",
+        help="Inject without authenticating, to a local stand-in API",
+    )
+    group = parser.add_argument_group(
+        "load generation",
+        "Inject tracker example messages of virtual modules instead of stdin",
+    )
+    group.add_argument(
+        "-n", "--load", type=int, metavar="MODULES", help="Number of virtual modules"
+    )
+    group.add_argument(
+        "-r", "--rate", type=float, default=10, help="Messages per second in total"
+    )
+    group.add_argument(
+        "-d", "--duration", type=float, default=60, help="Seconds to inject for"
+    )
+    group.add_argument(
+        "--prefix", default="load", help="Module Id prefix of virtual modules"
+    )
+    group.add_argument("--seed", type=int, help="Seed of virtual module positions")
     args = parser.parse_args(argv)
 
-    try:
-        myriota_auth.auth_token(myriota_auth.get_cached_token())
-    except (IOError, ValueError):
-        print("Run myriota_auth.py to generate security token first.")
-        return
-    idtoken = myriota_auth.auto_auth()
-    try:
-        do_inject(idtoken, args.moduleid)
-    except requests.exceptions.HTTPError as e:
-        print(e)
+    if args.workers <= 0 or args.window <= 0:
+        sys.exit("Invalid workers or window. Must be greater than zero")
+    if args.load is not None:
+        if args.moduleid:
+            sys.exit("A module Id can not be given with --load")
+        if args.load <= 0 or args.rate <= 0 or args.duration <= 0:
+            sys.exit("Invalid load, rate or duration. Must be greater than zero")
+
+    if args.no_auth:
+        idtoken = lambda: {"IdToken": ""}
+    else:
+        try:
+            myriota_auth.auth_token(myriota_auth.get_cached_token())
+        except (IOError, ValueError):
+            print("Run myriota_auth.py to generate security token first.")
+            return
+        idtoken = myriota_auth.auto_auth()
+    options = dict(
+        workers=args.workers,
+        window=args.window,
+        # messages of a single module given are only concurrent unordered
+        ordered=args.moduleid is None if args.ordered is None else args.ordered,
+        retries=args.retries,
+        backoff=args.backoff,
+        verbose=args.verbose,
+        url=args.api_url.rstrip("/") + "/messages",
+    )
+    if args.load is not None:
+        injector = do_load(
+            idtoken,
+            args.load,
+            args.rate,
+            args.duration,
+            args.prefix,
+            args.seed,
+            **options
+        )
+    else:
+        injector = do_inject(idtoken, args.moduleid, **options)
+    if injector.failed():
         sys.exit(1)
 
 
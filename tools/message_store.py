@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # Copyright (c) 2016-2020, Myriota Pty Ltd, All Rights Reserved
 # SPDX-License-Identifier: BSD-3-Clause-Attribution
@@ -14,16 +14,32 @@
 # limitations under the License.
 
 import sys
+
+if sys.version_info[0] < 3:
+    sys.exit("message_store.py requires Python 3")
+
 from datetime import datetime
 import myriota_auth
+from myriota_http import http_session
 import requests
 import json
 import time
+import concurrent.futures
+import os
+import sqlite3
+import collections
 
 _domain = "https://api.myriota.com/v1"
+_cache = myriota_auth.TOKEN_DIR + "/messages.db"
 
+# raised for a response body that is not JSON, a RequestException from
+# requests 2.27, the JSON module's error before
+JSONDecodeError = getattr(
+    requests.exceptions, "JSONDecodeError", requests.compat.json.JSONDecodeError
+)
 
-def do_query(idtoken, moduleid, range_from=None, limit=None):
+
+def do_query(idtoken, moduleid, range_from=None, limit=None, session=requests):
     params = []
     if range_from:
         params.append("from={}".format(range_from))
@@ -31,13 +47,280 @@ def do_query(idtoken, moduleid, range_from=None, limit=None):
         params.append("limit={}".format(limit))
 
     url = "?".join(["%s/data/%s/Message" % (_domain, moduleid), "&".join(params)])
-    response = requests.get(url, headers={"Authorization": idtoken})
+    response = session.get(url, headers={"Authorization": idtoken})
 
     response.raise_for_status()
 
     return response.json()["Items"]
 
 
+def retry_delay(error, attempt, backoff):
+    """
+    Returns seconds to wait before retrying a request that failed with error,
+    or None if it should not be retried. Rate limited requests wait as long
+    as the Retry-After header asks, other failures backoff seconds doubled on
+    each attempt.
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        if response.status_code != 429 and response.status_code < 500:
+            return None
+        try:
+            return float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            pass
+    return backoff * 2**attempt
+
+
+def do_query_retry(
+    idtoken,
+    moduleid,
+    range_from=None,
+    limit=None,
+    session=requests,
+    retries=3,
+    backoff=1.0,
+):
+    """do_query, retried up to retries times when rate limited or failing"""
+    for attempt in range(retries + 1):
+        try:
+            return do_query(idtoken, moduleid, range_from, limit, session)
+        except JSONDecodeError:
+            # a malformed response is not retried
+            raise
+        except requests.exceptions.RequestException as e:
+            delay = retry_delay(e, attempt, backoff)
+            if delay is None or attempt == retries:
+                raise
+            time.sleep(delay)
+
+
+def do_bulk_query(
+    idtoken,
+    moduleids,
+    range_from=None,
+    limit=None,
+    workers=8,
+    retries=3,
+    backoff=1.0,
+    out=None,
+):
+    """
+    Queries each of moduleids, running up to workers queries at a time over
+    one HTTP session. Results are written to out as JSON Lines in order of
+    completion, with the Items of each module or the Error that failed it.
+    Returns the number of modules queried and the number that failed.
+    """
+    out = out or sys.stdout
+    session = http_session(workers)
+    count, failed = 0, 0
+
+    def write(moduleid, future):
+        try:
+            result = {"ModuleId": moduleid, "Items": future.result()}
+        except (JSONDecodeError, KeyError, TypeError) as e:
+            # a malformed response fails only the module it was for
+            error = "Malformed response: {!r}".format(e)
+            result = {"ModuleId": moduleid, "Error": error}
+        except requests.exceptions.RequestException as e:
+            result = {"ModuleId": moduleid, "Error": str(e)}
+        out.write(json.dumps(result) + "\n")
+        return "Error" in result
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = {}
+        for moduleid in moduleids:
+            # bound the queued queries so module lists of any length can be read
+            if len(pending) >= 2 * workers:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    failed += write(pending.pop(future), future)
+            future = executor.submit(
+                do_query_retry,
+                idtoken,
+                moduleid,
+                range_from,
+                limit,
+                session,
+                retries,
+                backoff,
+            )
+            pending[future] = moduleid
+            count += 1
+        for future in concurrent.futures.as_completed(pending):
+            failed += write(pending[future], future)
+    out.flush()
+    return count, failed
+
+
+def read_moduleids(f):
+    """Generator of the module IDs listed in f, one per line"""
+    for line in f:
+        moduleid = line.split("#")[0].strip()
+        if moduleid:
+            yield moduleid
+
+
+def iter_messages(
+    idtoken, moduleid, range_from=0, range_to=None, page_size=1000, session=None
+):
+    """
+    Generator of the messages of moduleid received from range_from up to
+    range_to, in milliseconds since epoch. Pages of page_size are fetched on
+    one connection, each starting from the timestamp of the last message of
+    the previous page, so only one page is held in memory at a time. A full
+    page of messages at one timestamp is fetched again with a doubled limit
+    until it reaches later messages.
+    """
+    session = session or requests.Session()
+    cursor = range_from
+    limit = page_size
+    # count of each message at the cursor timestamp already returned, as the
+    # next page starts with them again
+    seen = collections.Counter()
+    capped = None
+    while True:
+        items = do_query(idtoken, moduleid, cursor, limit, session)
+        if capped and items:
+            # later messages were held back, so the page size was capped
+            print(
+                "Warning: only {1} messages of {0} at timestamp {2} returned, "
+                "any more are missing".format(moduleid, capped[1], capped[0]),
+                file=sys.stderr,
+            )
+        capped = None
+        last = cursor
+        repeated = collections.Counter()
+        for item in items:
+            timestamp = item["Timestamp"]
+            if range_to is not None and timestamp > range_to:
+                return
+            if timestamp < cursor:
+                continue
+            key = json.dumps(item, sort_keys=True)
+            if timestamp == cursor:
+                repeated[key] += 1
+                if repeated[key] <= seen[key]:
+                    continue
+            if timestamp != last:
+                last = timestamp
+                seen = collections.Counter()
+            seen[key] += 1
+            yield item
+        if last != cursor:
+            if len(items) < limit:
+                return
+            cursor, limit = last, page_size
+        elif len(items) == limit:
+            # a whole page at the cursor timestamp
+            limit *= 2
+        elif limit > page_size and len(items) == limit // 2:
+            # no more messages returned for a larger limit, either there are
+            # none or the Message Store caps the page size
+            capped = (cursor, len(items))
+            cursor, limit = cursor + 1, page_size
+            seen = collections.Counter()
+        else:
+            return
+
+
+def do_export(idtoken, moduleid, range_from=0, range_to=None, page_size=1000, out=None):
+    """Writes the messages of moduleid to out as JSON Lines, returns the count"""
+    out = out or sys.stdout
+    count = 0
+    for item in iter_messages(idtoken, moduleid, range_from, range_to, page_size):
+        out.write(json.dumps(item) + "\n")
+        count += 1
+        if count % page_size == 0:
+            out.flush()
+    out.flush()
+    return count
+
+
+class MessageCache(object):
+    """
+    Local SQLite store of the messages of modules, indexed by module ID and
+    timestamp. The timestamp of the last message synced of each module is
+    kept as its high-water mark, so syncing only fetches newer messages.
+    """
+
+    def __init__(self, filename=_cache):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(filename)
+        # queries can be served while syncing
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "moduleid TEXT NOT NULL, timestamp INTEGER NOT NULL, "
+                "item TEXT NOT NULL, UNIQUE (moduleid, timestamp, item))"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS sync ("
+                "moduleid TEXT PRIMARY KEY, timestamp INTEGER NOT NULL, "
+                "synced REAL NOT NULL)"
+            )
+
+    def close(self):
+        self.db.close()
+
+    def high_water_mark(self, moduleid):
+        """Timestamp of the last message synced of moduleid, None if never synced"""
+        row = self.db.execute(
+            "SELECT timestamp FROM sync WHERE moduleid = ?", (moduleid,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def add(self, moduleid, items, timestamp):
+        """Stores items of moduleid and moves its high-water mark to timestamp"""
+        with self.db:
+            cursor = self.db.executemany(
+                "INSERT OR IGNORE INTO messages VALUES (?, ?, ?)",
+                [(moduleid, item["Timestamp"], json.dumps(item)) for item in items],
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO sync VALUES (?, ?, ?)",
+                (moduleid, timestamp, time.time()),
+            )
+        return cursor.rowcount
+
+    def sync(self, idtoken, moduleid, range_from=0, page_size=1000, session=None):
+        """
+        Fetches the messages of moduleid newer than its high-water mark, or
+        from range_from if never synced. Returns the number of new messages.
+        """
+        hwm = self.high_water_mark(moduleid)
+        # messages at the high-water mark are fetched again, as more may
+        # have been received at the same timestamp since the last sync
+        timestamp = range_from if hwm is None else hwm
+        count = 0
+        items = []
+        for item in iter_messages(
+            idtoken, moduleid, timestamp, None, page_size, session
+        ):
+            items.append(item)
+            if len(items) == page_size:
+                count += self.add(moduleid, items, items[-1]["Timestamp"])
+                items = []
+        if items:
+            timestamp = items[-1]["Timestamp"]
+        count += self.add(moduleid, items, timestamp)
+        return count
+
+    def query(self, moduleid, range_from=0, limit=None):
+        """Returns up to limit messages of moduleid from range_from, oldest first"""
+        rows = self.db.execute(
+            "SELECT item FROM messages WHERE moduleid = ? AND timestamp >= ? "
+            "ORDER BY timestamp, rowid LIMIT ?",
+            (moduleid, range_from, -1 if limit is None else limit),
+        )
+        return [json.loads(row[0]) for row in rows]
+
+
 def main(argv=None, auth=myriota_auth.auth):
     """CLI entrypoint."""
     import getpass
@@ -71,14 +354,149 @@ def main(argv=None, auth=myriota_auth.auth):
         default=100,
         help="Maximum number of entries to return",
     )
+    sub_parser.add_argument(
+        "-c",
+        "--cached",
+        action="store_true",
+        help="Serve query from the local cache updated by the sync command",
+    )
+    sub_parser.add_argument("--cache", default=_cache, help="Local message cache file")
+
+    sub_parser = subparsers.add_parser(
+        "export",
+        help="Export all received messages as JSON Lines",
+        description="Export all messages received in a time range as JSON Lines, "
+        "one message per line, fetched page by page",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    sub_parser.add_argument("moduleid", help="Module Id")
+    sub_parser.add_argument(
+        "-f",
+        "--from",
+        dest="range_from",
+        type=int,
+        default=0,
+        help="Unix epoch second to start export from",
+    )
+    sub_parser.add_argument(
+        "-t",
+        "--to",
+        dest="range_to",
+        type=int,
+        help="Unix epoch second to end export at",
+    )
+    sub_parser.add_argument(
+        "-p",
+        "--page-size",
+        type=int,
+        default=1000,
+        help="Number of entries to fetch per request",
+    )
+    sub_parser.add_argument(
+        "-o",
+        "--output",
+        help="Output file, stdout if not specified",
+    )
+
+    sub_parser = subparsers.add_parser(
+        "bulk",
+        help="Query Message Store for messages of many modules",
+        description="Query Message Store concurrently for the messages of each "
+        "module listed in a file, one module ID per line. Results are output as "
+        "JSON Lines, one module per line",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    sub_parser.add_argument("modules", help="File listing module IDs, - for stdin")
+    sub_parser.add_argument(
+        "-f",
+        "--from",
+        dest="range_from",
+        type=int,
+        default=0,
+        help="Unix epoch second to start query from",
+    )
+    sub_parser.add_argument(
+        "-l",
+        "--limit",
+        type=int,
+        default=100,
+        help="Maximum number of entries to return per module",
+    )
+    sub_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of concurrent queries",
+    )
+    sub_parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Number of times a rate limited or failed query is retried",
+    )
+    sub_parser.add_argument(
+        "--backoff",
+        type=float,
+        default=1.0,
+        help="Seconds to wait before the first retry, doubled on each retry",
+    )
+    sub_parser.add_argument(
+        "-o",
+        "--output",
+        help="Output file, stdout if not specified",
+    )
+
+    sub_parser = subparsers.add_parser(
+        "sync",
+        help="Update local cache with newly received messages",
+        description="Fetch messages received since the last sync of each module "
+        "into the local cache, for queries with --cached",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    sub_parser.add_argument("moduleid", nargs="*", help="Module Id")
+    sub_parser.add_argument(
+        "-m",
+        "--modules",
+        help="File listing module IDs to sync, one per line, - for stdin",
+    )
+    sub_parser.add_argument(
+        "-f",
+        "--from",
+        dest="range_from",
+        type=int,
+        default=0,
+        help="Unix epoch second to start from for modules never synced",
+    )
+    sub_parser.add_argument(
+        "-p",
+        "--page-size",
+        type=int,
+        default=1000,
+        help="Number of entries to fetch per request",
+    )
+    sub_parser.add_argument("--cache", default=_cache, help="Local message cache file")
 
     args = parser.parse_args(argv)
 
     # Validate inputs
-    if args.limit <= 0:
+    if args.command in ("query", "bulk") and args.limit <= 0:
         sys.exit("Invalid limit. Must be an integer which is greater than zero")
+    if args.command in ("export", "sync") and args.page_size <= 0:
+        sys.exit("Invalid page size. Must be an integer which is greater than zero")
+    if args.command == "bulk" and args.workers <= 0:
+        sys.exit("Invalid workers. Must be an integer which is greater than zero")
 
-    if args.command == "query":
+    if args.command == "query" and args.cached:
+        cache = MessageCache(args.cache)
+        try:
+            if cache.high_water_mark(args.moduleid) is None:
+                sys.exit("Module %s has not been synced" % args.moduleid)
+            items = cache.query(args.moduleid, args.range_from * 1000, args.limit)
+        finally:
+            cache.close()
+        return json.dumps(items, indent=2)
+    elif args.command == "query":
         range_from = args.range_from * 1000
         idtoken = auth()["IdToken"]
         try:
@@ -86,9 +504,77 @@ def main(argv=None, auth=myriota_auth.auth):
         except requests.exceptions.RequestException as e:
             raise SystemExit(e)
         return json.dumps(items, indent=2)
+    elif args.command == "export":
+        range_from = args.range_from * 1000
+        range_to = None if args.range_to is None else args.range_to * 1000 + 999
+        idtoken = auth()["IdToken"]
+        out = open(args.output, "w") if args.output else sys.stdout
+        try:
+            count = do_export(
+                idtoken, args.moduleid, range_from, range_to, args.page_size, out
+            )
+        except requests.exceptions.RequestException as e:
+            raise SystemExit(e)
+        finally:
+            if args.output:
+                out.close()
+        sys.stderr.write("Exported %d messages\n" % count)
+    elif args.command == "bulk":
+        range_from = args.range_from * 1000
+        idtoken = auth()["IdToken"]
+        modules = sys.stdin if args.modules == "-" else open(args.modules)
+        out = open(args.output, "w") if args.output else sys.stdout
+        start = time.time()
+        try:
+            count, failed = do_bulk_query(
+                idtoken,
+                read_moduleids(modules),
+                range_from,
+                args.limit,
+                args.workers,
+                args.retries,
+                args.backoff,
+                out,
+            )
+        finally:
+            if args.modules != "-":
+                modules.close()
+            if args.output:
+                out.close()
+        elapsed = time.time() - start
+        sys.stderr.write(
+            "Queried %d modules in %.1fs (%.1f modules/s), %d failed\n"
+            % (count, elapsed, count / max(elapsed, 1e-9), failed)
+        )
+        if failed:
+            sys.exit(1)
+    elif args.command == "sync":
+        moduleids = args.moduleid
+        if args.modules:
+            modules = sys.stdin if args.modules == "-" else open(args.modules)
+            moduleids += list(read_moduleids(modules))
+            if args.modules != "-":
+                modules.close()
+        if not moduleids:
+            sys.exit("No module IDs to sync")
+        idtoken = auth()["IdToken"]
+        cache = MessageCache(args.cache)
+        session = requests.Session()
+        try:
+            for moduleid in moduleids:
+                count = cache.sync(
+                    idtoken, moduleid, args.range_from * 1000, args.page_size, session
+                )
+                sys.stderr.write("%s: %d new messages\n" % (moduleid, count))
+        except requests.exceptions.RequestException as e:
+            raise SystemExit(e)
+        finally:
+            cache.close()
     else:
         return "Invalid command"
 
 
 if __name__ == "__main__":
-    print(main())
+    result = main()
+    if result is not None:
+        print(result)
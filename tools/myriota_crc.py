@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Myriota Pty Ltd, All Rights Reserved
+# SPDX-License-Identifier: BSD-3-Clause-Attribution
+#
+# This file is licensed under the BSD with attribution  (the "License"); you
+# may not use these files except in compliance with the License.
+#
+# You may obtain a copy of the License here:
+# LICENSE-BSD-3-Clause-Attribution.txt and at
+# https://spdx.org/licenses/BSD-3-Clause-Attribution.html
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from __future__ import print_function
+import array
+import binascii
+import sys
+
+# CRC-16/XMODEM as used by the bootloader and merged binary headers
+POLY = 0x11021
+BIT_SIZE = 16
+
+
+def _bytecrc(crc, poly, n):
+    mask = 1 << (n - 1)
+    for i in range(8):
+        if crc & mask:
+            crc = (crc << 1) ^ poly
+        else:
+            crc = crc << 1
+    mask = (1 << n) - 1
+    crc = crc & mask
+    return crc
+
+
+# _TABLE advances the CRC by one byte. The 65536 entry table advancing it by
+# two bytes at once (slicing-by-2), a single lookup per big-endian 16-bit word
+# for a 16-bit register, is only built on first use of crc16_table.
+_TABLE = [_bytecrc(i << (BIT_SIZE - 8), POLY, BIT_SIZE) for i in range(256)]
+_TABLE16 = None
+
+
+def _table16():
+    global _TABLE16
+    if _TABLE16 is None:
+        hi = [_TABLE[_TABLE[i] >> 8] ^ ((_TABLE[i] << 8) & 0xFF00) for i in range(256)]
+        # assigned whole, so concurrent first calls never see a partial table
+        _TABLE16 = [hi[i >> 8] ^ _TABLE[i & 0xFF] for i in range(1 << 16)]
+    return _TABLE16
+
+
+def crc16_table(data, crc=0):
+    """
+    Pure Python table driven CRC-16/XMODEM of data, continuing from crc.
+    Processes two bytes per iteration.
+    """
+    view = memoryview(data)
+    if view.ndim != 1 or view.itemsize != 1:
+        view = view.cast("B")
+    even = len(view) & ~1
+    words = array.array("H", view[:even].tobytes())
+    if sys.byteorder == "little":
+        words.byteswap()
+    table = _table16()
+    for w in words:
+        crc = table[crc ^ w]
+    if even != len(view):
+        crc = _TABLE[view[even] ^ (crc >> 8)] ^ ((crc << 8) & 0xFF00)
+    return crc
+
+
+def crc16(data, crc=0):
+    """
+    CRC-16/XMODEM of data, continuing from crc. Accepts any object supporting
+    the buffer protocol, including memoryview slices, without copying.
+    """
+    # binascii.crc_hqx implements the same CRC in C
+    return binascii.crc_hqx(data, crc)
+
+
+def calc_crc(data):
+    """Returns the CRC-16/XMODEM of data"""
+    return crc16(data)
+
+
+class Crc16(object):
+    """Incremental CRC-16/XMODEM for data arriving in pieces"""
+
+    def __init__(self, data=None):
+        self.crc = 0
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        self.crc = crc16(data, self.crc)
+        return self
+
+    def value(self):
+        return self.crc
+
+
+def _legacy_calc_crc(data):
+    # Per call implementation previously used by updater.py and merge_binary.py
+    table = [_bytecrc(i << (BIT_SIZE - 8), POLY, BIT_SIZE) for i in range(256)]
+    crc = 0
+    for b in data:
+        crc = table[b ^ ((crc >> 8) & 0xFF)] ^ ((crc << 8) & 0xFF00)
+    return crc
+
+
+def benchmark(size, block_size):
+    """Time CRC implementations over size bytes in block_size pieces"""
+    import os
+    import timeit
+
+    data = bytearray(os.urandom(size))
+    view = memoryview(data)
+    blocks = [view[i : i + block_size] for i in range(0, size, block_size)]
+
+    def per_block(f):
+        return lambda: [f(b) for b in blocks]
+
+    def streaming(f):
+        def run():
+            crc = 0
+            for b in blocks:
+                crc = f(b, crc)
+            return crc
+
+        return run
+
+    expected = _legacy_calc_crc(data)
+    if crc16(data) != expected or crc16_table(data) != expected:
+        raise AssertionError("CRC mismatch")
+    if streaming(crc16)() != expected or streaming(crc16_table)() != expected:
+        raise AssertionError("streaming CRC mismatch")
+
+    print("CRC of %d bytes in %d byte blocks (seconds per pass)" % (size, block_size))
+    cases = [
+        ("legacy per call table", per_block(_legacy_calc_crc)),
+        ("cached table, slicing-by-2", per_block(crc16_table)),
+        ("cached table, streaming", streaming(crc16_table)),
+        ("binascii.crc_hqx", per_block(crc16)),
+        ("binascii.crc_hqx, streaming", streaming(crc16)),
+    ]
+    for name, f in cases:
+        t = min(timeit.repeat(f, number=1, repeat=3))
+        print("%-32s %10.4f %8.1f MB/s" % (name, t, size / t / 1e6))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="CRC-16/XMODEM utility and microbenchmark",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("files", nargs="*", metavar="FILE", help="print CRC of FILE")
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        metavar="BYTES",
+        help="benchmark CRC implementations over BYTES of random data",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=128,
+        help="block size used by the benchmark",
+    )
+    args = parser.parse_args()
+
+    for filename in args.files:
+        crc = Crc16()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 16), b""):
+                crc.update(block)
+        print("%04x  %s" % (crc.value(), filename))
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.block_size)
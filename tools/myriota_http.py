@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Myriota Pty Ltd, All Rights Reserved
+# SPDX-License-Identifier: BSD-3-Clause-Attribution
+#
+# This file is licensed under the BSD with attribution  (the "License"); you
+# may not use these files except in compliance with the License.
+#
+# You may obtain a copy of the License here:
+# LICENSE-BSD-3-Clause-Attribution.txt and at
+# https://spdx.org/licenses/BSD-3-Clause-Attribution.html
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import requests
+import requests.adapters
+
+
+def http_session(connections):
+    """Returns a requests.Session keeping up to connections alive per host"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=connections)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Myriota Pty Ltd, All Rights Reserved
+# SPDX-License-Identifier: BSD-3-Clause-Attribution
+#
+# This file is licensed under the BSD with attribution  (the "License"); you
+# may not use these files except in compliance with the License.
+#
+# You may obtain a copy of the License here:
+# LICENSE-BSD-3-Clause-Attribution.txt and at
+# https://spdx.org/licenses/BSD-3-Clause-Attribution.html
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from __future__ import print_function
+import math
+import sys
+
+if sys.version_info[0] < 3:
+    sys.exit("myriota_resample.py requires Python 3")
+
+import numpy
+
+# sample types with the offset removed on input, as by convert_type
+SAMPLE_TYPES = {
+    "uint8": (numpy.uint8, 128.0),
+    "int8": (numpy.int8, 0.0),
+    "int16": (numpy.int16, 0.0),
+    "uint16": (numpy.uint16, 32768.0),
+    "int32": (numpy.int32, 0.0),
+    "float": (numpy.float32, 0.0),
+    "double": (numpy.float64, 0.0),
+}
+
+
+def rational_approximation(x, tol=1e-6, qmax=1000, k=10):
+    """
+    Returns (p, q) with p/q approximating x, chosen as by
+    myriota_rational_approximation: the first convergent of the continued
+    fraction of x within tol, or the last one with denominator up to qmax.
+    """
+    convergents = []
+    hn, hn1, kn, kn1 = 1, 0, 0, 1
+    rem = x
+    for _ in range(k):
+        an = int(math.floor(rem))
+        hn, hn1 = an * hn + hn1, hn
+        kn, kn1 = an * kn + kn1, kn
+        convergents.append((hn, kn))
+        if rem == an:
+            break
+        rem = 1.0 / (rem - an)
+    for i, (p, q) in enumerate(convergents):
+        if i > 0 and q > qmax:
+            return convergents[i - 1]
+        if abs(x * q - p) < abs(q * tol):
+            return p, q
+    return convergents[-1]
+
+
+def window(t, W):
+    """Blackman windowed sinc of myriota::Resample, zero outside [-W, W]"""
+    t = numpy.asarray(t, dtype=numpy.float64)
+    # numpy.sinc is sin(pi t) / (pi t), as myriota_sinc
+    blackman = (
+        21.0 / 50
+        + 0.5 * numpy.cos(numpy.pi * t / W)
+        + 2.0 / 25 * numpy.cos(2 * numpy.pi * t / W)
+    )
+    return numpy.where(numpy.abs(t) <= W, numpy.sinc(t) * blackman, 0.0)
+
+
+class Resampler(object):
+    """
+    Block based equivalent of myriota::ResampleDouble. Complex samples pushed
+    in blocks are resampled from in_rate to out_rate with a Blackman windowed
+    sinc of window width W, and produce the same output samples as the
+    resample tool, up to floating point rounding.
+
+    Output n is the sum of input samples m weighted by g(q n - p m) for
+    out_rate / in_rate = p / q. Outputs n and n + p share their taps, so each
+    of the p phases is a decimate by q FIR filter, computed as a matrix
+    product over the input reshaped into rows of q samples.
+    """
+
+    def __init__(self, in_rate, out_rate, W=30):
+        self.W = W
+        self.p, self.q = rational_approximation(out_rate / in_rate)
+        p, q = self.p, self.q
+        self.gamma = float(p) / q
+        self.kappa = min(1.0, self.gamma)
+        self.delta = max(1.0, self.gamma)
+        xi = max(p, q)
+        gmin = int(math.ceil(-xi * W))
+        gmax = int(math.floor(xi * W))
+
+        # first input of each phase is L(n) = ceil((q n - gmax) / p), the
+        # taps of the phase are g(d - p j) for d = q n - p L(n)
+        self.ntaps = (gmax - gmin) // p + 2
+        self.rows = -(-self.ntaps // q)
+        self.taps = []
+        for r in range(p):
+            d = q * r - p * self.first_input(r)
+            g = self.kappa * window((d - p * numpy.arange(self.ntaps)) / xi, W)
+            taps = numpy.zeros(self.rows * q)
+            taps[: self.ntaps] = g
+            self.taps.append(taps.reshape(self.rows, q).T.copy())
+
+        # real and imaginary parts of the inputs from index base, inputs
+        # before the first are zero as in the circular buffer of Resample
+        self.base = self.first_input(0)
+        self.buf = numpy.zeros((2, -self.base))
+        self.pushed = 0
+        self.n = 0
+
+    def first_input(self, n):
+        """Index of the first input sample weighted into output n"""
+        xi = max(self.p, self.q)
+        gmax = int(math.floor(xi * self.W))
+        return -((gmax - self.q * n) // self.p)
+
+    def maxn(self):
+        """Index of the last output computable from the inputs pushed so far"""
+        return int(math.floor(self.gamma * (self.pushed - 2) - self.delta * self.W))
+
+    def push(self, x):
+        """
+        Appends input samples x, a complex array or an array of shape (2, N)
+        holding real and imaginary parts. Returns the output samples now
+        computable as an array of shape (2, N).
+        """
+        x = numpy.asarray(x)
+        if numpy.iscomplexobj(x):
+            x = numpy.stack([x.real, x.imag])
+        self.buf = numpy.concatenate([self.buf, x], axis=1)
+        self.pushed += x.shape[1]
+
+        n0, n1 = self.n, self.maxn() + 1
+        y = numpy.zeros((2, max(n1 - n0, 0)))
+        for r in range(min(self.p, n1 - n0)):
+            n = n0 + r
+            count = (n1 - n + self.p - 1) // self.p
+            phase = n % self.p
+            y[:, r :: self.p] = self.filter(self.first_input(n), count, phase)
+        if n1 > n0:
+            self.n = n1
+            # drop inputs no longer needed by later outputs
+            drop = self.first_input(self.n) - self.base
+            self.buf = self.buf[:, drop:]
+            self.base += drop
+        return y
+
+    def filter(self, first, count, phase):
+        """Outputs count of phase, the first weighting from input first"""
+        q, rows = self.q, self.rows
+        start = first - self.base
+        length = (count + rows - 1) * q
+        x = self.buf[:, start : start + length]
+        if x.shape[1] < length:
+            # only multiplied by zero taps
+            x = numpy.pad(x, ((0, 0), (0, length - x.shape[1])))
+        # z[:, k, i] is the weighted sum of row k of inputs with row i of taps
+        z = numpy.matmul(x.reshape(2, count + rows - 1, q), self.taps[phase])
+        y = z[:, :count, 0].copy()
+        for i in range(1, rows):
+            y += z[:, i : i + count, i]
+        return y
+
+
+def to_samples(data, sample_type):
+    """
+    Converts interleaved IQ data of sample_type to an array of shape (2, N)
+    with the offset of unsigned types removed, as convert_type -f.
+    """
+    dtype, offset = SAMPLE_TYPES[sample_type]
+    x = numpy.frombuffer(data, dtype=dtype)
+    x = x[: len(x) & ~1].astype(numpy.float64) - offset
+    return x.reshape(-1, 2).T
+
+
+def from_samples(y, sample_type):
+    """
+    Returns samples y of shape (2, N) as interleaved IQ data of sample_type,
+    saturated and truncated as convert_type -t.
+    """
+    dtype, offset = SAMPLE_TYPES[sample_type]
+    y = y.T + offset
+    if numpy.issubdtype(dtype, numpy.integer):
+        info = numpy.iinfo(dtype)
+        y = numpy.clip(y, info.min, info.max)
+    return y.astype(dtype).tobytes()
+
+
+class ResampledStream(object):
+    """
+    Readable stream of samples from stream, converted from in_type, resampled
+    and converted to out_type. Replaces the pipeline
+    convert_type -f in_type | resample | convert_type -t out_type.
+    """
+
+    def __init__(
+        self,
+        stream,
+        in_rate,
+        out_rate,
+        in_type="uint8",
+        out_type="int16",
+        W=30,
+        block_size=1 << 18,
+    ):
+        self.stream = stream
+        self.resampler = Resampler(in_rate, out_rate, W)
+        self.in_type = in_type
+        self.out_type = out_type
+        # read whole input samples
+        self.block_size = block_size - block_size % (
+            2 * numpy.dtype(SAMPLE_TYPES[in_type][0]).itemsize
+        )
+        self.pending = memoryview(b"")
+
+    def readinto(self, b):
+        while not self.pending:
+            data = self.stream.read(self.block_size)
+            if not data:
+                return 0
+            y = self.resampler.push(to_samples(data, self.in_type))
+            self.pending = memoryview(from_samples(y, self.out_type))
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def read(self, size=-1):
+        if size < 0:
+            return b"".join(iter(lambda: self.read(1 << 20), b""))
+        b = bytearray(size)
+        return bytes(b[: self.readinto(b)])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Resamples complex samples from input rate to output rate "
+        "in blocks with NumPy, as convert_type | resample | convert_type. Input "
+        "samples via stdin, output samples are written to stdout."
+    )
+    parser.add_argument(
+        "-i", "--input-rate", type=float, required=True, help="input sample rate"
+    )
+    parser.add_argument(
+        "-r", "--output-rate", type=float, required=True, help="output sample rate"
+    )
+    parser.add_argument(
+        "-W",
+        "--window-width",
+        type=float,
+        default=30,
+        help="larger is slower, but more accurate",
+    )
+    parser.add_argument(
+        "-f", "--from", dest="in_type", choices=sorted(SAMPLE_TYPES), default="double"
+    )
+    parser.add_argument(
+        "-t", "--to", dest="out_type", choices=sorted(SAMPLE_TYPES), default="double"
+    )
+    args = parser.parse_args()
+
+    stream = ResampledStream(
+        sys.stdin.buffer,
+        args.input_rate,
+        args.output_rate,
+        args.in_type,
+        args.out_type,
+        args.window_width,
+    )
+    for block in iter(lambda: stream.read(1 << 16), b""):
+        sys.stdout.buffer.write(block)
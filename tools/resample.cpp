@@ -13,24 +13,82 @@
 
 #include <stdio.h>
 #include <stdlib.h>
+#include <time.h>
 #include <complex>
 #include <cstdint>
+#include <vector>
 #include "math/myriotamath.h"
 #include "tools/cmdline.h"
+#include "tools/stream_io.h"
 
 using namespace myriota;
 
+// maximum number of input samples read per block
+static const size_t block_size = 1 << 16;
+
+// Resamples infile to outfile, returns the number of output samples
+template <class R, class C>
+int64_t resample(FILE *infile, FILE *outfile, R &r) {
+  std::vector<C> x(block_size);
+  std::vector<C> y(r.max_output(block_size));
+  int64_t n = 0;
+  size_t count;
+  while ((count = read_available(infile, x.data(), sizeof(C), block_size))) {
+    const size_t written = r.process(x.data(), count, y.data(), n);
+    fwrite(y.data(), sizeof(C), written, outfile);
+    // pass samples on as they arrive rather than in stdio buffer sized bursts
+    fflush(outfile);
+  }
+  return n;
+}
+
+static complex random_sample(complex) {
+  return complex(rand() % 256 - 128, rand() % 256 - 128);
+}
+
+static myriota_complex_16 random_sample(myriota_complex_16) {
+  return (myriota_complex_16){(int16_t)(rand() % 256 - 128),
+                              (int16_t)(rand() % 256 - 128)};
+}
+
+// Resamples count random input samples held in memory, or if io read from a
+// temporary file and written to /dev/null block by block as from stdin, and
+// prints the input and output throughput in samples per second.
 template <class R, class C>
-void resample(FILE *infile, R &r) {
-  for (int64_t n = 0; n >= 0; n++) {
-    while (r.maxn() < n) {
-      C x;
-      if (fread(&x, sizeof(C), 1, infile) != 1) return;
-      r.push(x);
+void benchmark(R &r, size_t count, bool io) {
+  std::vector<C> x(count);
+  for (size_t i = 0; i < count; i++) x[i] = random_sample(C());
+  std::vector<C> y(r.max_output(block_size));
+  int64_t n = 0;
+  FILE *infile = NULL, *outfile = NULL;
+  if (io) {
+    infile = tmpfile();
+    outfile = fopen("/dev/null", "wb");
+    if (infile == NULL || outfile == NULL) {
+      perror("benchmark");
+      exit(EXIT_FAILURE);
     }
-    const C rn = r(n);
-    fwrite(&rn, sizeof(C), 1, stdout);
+    fwrite(x.data(), sizeof(C), count, infile);
+    rewind(infile);
+  }
+  const clock_t start = clock();
+  if (io) {
+    n = resample<R, C>(infile, outfile, r);
+  } else {
+    for (size_t i = 0; i < count; i += block_size) {
+      const size_t block = count - i < block_size ? count - i : block_size;
+      r.process(x.data() + i, block, y.data(), n);
+    }
+  }
+  const double seconds = (double)(clock() - start) / CLOCKS_PER_SEC;
+  if (io) {
+    fclose(infile);
+    fclose(outfile);
   }
+  printf("%zu input samples, %" PRId64 " output samples in %.3f s\n", count, n,
+         seconds);
+  printf("%.0f input samples/s, %.0f output samples/s\n", count / seconds,
+         n / seconds);
 }
 
 int main(int argc, char **argv) {
@@ -47,6 +105,13 @@ int main(int argc, char **argv) {
                  "Replace division with shift, only with --int16 option.");
   cmd_parser.add<std::string>("taps", '\0',
                               "print filter taps in verilog format.", false);
+  cmd_parser.add<size_t>(
+      "benchmark", '\0',
+      "resample this many random samples in memory and print throughput.",
+      false, 0);
+  cmd_parser.add("io", '\0',
+                 "with --benchmark, read the samples from a file and write the "
+                 "output to /dev/null, as when resampling stdin.");
   cmd_parser.set_description(
       "Resamples complex samples from input rate to output rate. Input samples "
       "via stdin, output samples are written to stdout. By default the input "
@@ -58,6 +123,8 @@ int main(int argc, char **argv) {
   const double in_rate = cmd_parser.get<double>("input_rate");
   const double out_rate = cmd_parser.get<double>("output_rate");
   const double W = cmd_parser.get<double>("window_width");
+  const size_t bench = cmd_parser.get<size_t>("benchmark");
+  const bool io = cmd_parser.exist("io");
 
   if (cmd_parser.exist("taps")) {
     Resample16shift r = Resample16shift(in_rate, out_rate, W);
@@ -72,13 +139,22 @@ int main(int argc, char **argv) {
 
   if (cmd_parser.exist("int16") && cmd_parser.exist("shift")) {
     Resample16shift r = Resample16shift(in_rate, out_rate, W);
-    resample<Resample16shift, myriota_complex_16>(stdin, r);
+    if (bench)
+      benchmark<Resample16shift, myriota_complex_16>(r, bench, io);
+    else
+      resample<Resample16shift, myriota_complex_16>(stdin, stdout, r);
   } else if (cmd_parser.exist("int16")) {
     Resample16 r = Resample16(in_rate, out_rate, W);
-    resample<Resample16, myriota_complex_16>(stdin, r);
+    if (bench)
+      benchmark<Resample16, myriota_complex_16>(r, bench, io);
+    else
+      resample<Resample16, myriota_complex_16>(stdin, stdout, r);
   } else {  // double format by default
     ResampleDouble r = ResampleDouble(in_rate, out_rate, W);
-    resample<ResampleDouble, complex>(stdin, r);
+    if (bench)
+      benchmark<ResampleDouble, complex>(r, bench, io);
+    else
+      resample<ResampleDouble, complex>(stdin, stdout, r);
   }
 
   return EXIT_SUCCESS;
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # Copyright (c) 2016-2020, Myriota Pty Ltd, All Rights Reserved
 # SPDX-License-Identifier: BSD-3-Clause-Attribution
@@ -16,18 +16,518 @@
 
 from __future__ import print_function
 
+import sys
+
+if sys.version_info[0] < 3:
+    sys.exit("satellite_simulator.py requires Python 3")
+
 import bz2
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from distutils.spawn import find_executable
 import getpass
 from io import BytesIO
+import json
+from myriota_http import http_session
+import mmap
 import os.path
 import requests
 import subprocess
-import sys
+import threading
 import time
-from threading import Timer, Thread
 from uuid import uuid4
 
+# compression codecs with the acquisition ID extension and default level of each
+CODECS = {
+    "bz2": (".bz2", 9),
+    "zstd": (".zst", 3),
+    "lz4": (".lz4", 0),
+    "none": ("", None),
+}
+
+
+def compress(data, codec="bz2", level=None):
+    """
+    Returns data, any object supporting the buffer protocol, compressed with
+    codec at level, by default the level of the codec in CODECS. bz2, zstd
+    and lz4 release the GIL while compressing.
+    """
+    if level is None:
+        level = CODECS[codec][1]
+    if codec == "bz2":
+        return bz2.compress(data, level)
+    if codec == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise IOError(
+                "zstandard: module not found. Please check your installation."
+            )
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if codec == "lz4":
+        try:
+            import lz4.frame
+        except ImportError:
+            raise IOError("lz4: module not found. Please check your installation.")
+        return lz4.frame.compress(data, compression_level=level)
+    if codec == "none":
+        return bytes(data)
+    raise ValueError("Unknown codec {}".format(codec))
+
+
+class Metrics(object):
+    """
+    Counters and latency distributions of the capture pipeline. Latency
+    percentiles are over the last window observations of each kind.
+    """
+
+    COUNTERS = [
+        "bytes_read",
+        "raw_bytes",
+        "compressed_bytes",
+        "chunks_uploaded",
+        "chunks_failed",
+        "chunks_spooled",
+        "chunks_dropped",
+        "spool_uploaded",
+    ]
+    LATENCIES = ["compress", "url", "put"]
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.counters = dict((name, 0) for name in self.COUNTERS)
+        self.latencies = dict((name, deque(maxlen=window)) for name in self.LATENCIES)
+        # running sum and count of each latency, as Prometheus summaries
+        self.totals = dict((name, [0.0, 0]) for name in self.LATENCIES)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.latencies[name].append(seconds)
+            self.totals[name][0] += seconds
+            self.totals[name][1] += 1
+
+    def percentiles(self, name, ps=(50, 90, 99)):
+        """Returns the ps percentiles of latency name, None if unobserved"""
+        with self.lock:
+            values = sorted(self.latencies[name])
+        if not values:
+            return [None for p in ps]
+        return [values[min(len(values) - 1, len(values) * p // 100)] for p in ps]
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+class Capture(object):
+    """
+    Stands in for the capture process, providing int16 IQ samples on stdout.
+    wait returns the exit code of process, if any. realtime is False if
+    samples arrive faster than they were captured.
+    """
+
+    def __init__(self, stdout, process=None, realtime=True):
+        self.stdout = stdout
+        self.process = process
+        self.realtime = realtime
+
+    def wait(self):
+        return self.process.wait() if self.process else 0
+
+
+class MappedFile(object):
+    """Readable stream over a memory mapped file"""
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.map = b""
+        self.view = memoryview(self.map)
+        self.pos = 0
+
+    def readinto(self, b):
+        n = min(len(b), len(self.view) - self.pos)
+        b[:n] = self.view[self.pos : self.pos + n]
+        self.pos += n
+        return n
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.view) - self.pos
+        data = self.view[self.pos : self.pos + size].tobytes()
+        self.pos += len(data)
+        return data
+
+
+class PacedStream(object):
+    """
+    Readable stream over stream delivering at most byte_rate bytes per second,
+    as samples arrive from a receiver.
+    """
+
+    def __init__(self, stream, byte_rate):
+        self.stream = stream
+        self.byte_rate = byte_rate
+        self.start = None
+        self.delivered = 0
+
+    def pace(self, size):
+        if self.start is None:
+            self.start = time.time()
+        delay = self.start + (self.delivered + size) / self.byte_rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def readinto(self, b):
+        self.pace(len(b))
+        n = self.stream.readinto(b)
+        self.delivered += n
+        return n
+
+    def read(self, size=-1):
+        if size < 0:
+            return b"".join(iter(lambda: self.read(1 << 16), b""))
+        b = bytearray(size)
+        return bytes(b[: self.readinto(b)])
+
+
+class Spool(object):
+    """
+    Directory of compressed chunks awaiting upload. Each chunk is written to
+    a temporary file and renamed into place before it is recorded in the
+    manifest, itself replaced atomically, so the manifest only ever lists
+    complete chunks.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        try:
+            with open(self.path(self.MANIFEST)) as f:
+                self.manifest = json.load(f)
+            if not isinstance(self.manifest, dict):
+                raise ValueError("not a JSON object")
+        except IOError:
+            self.manifest = {}
+        except ValueError as e:
+            print("Spool manifest corrupt:{}, rebuilding".format(e), file=sys.stderr)
+            self.manifest = self.scan()
+            self.write_manifest()
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def scan(self):
+        """
+        Returns a manifest of the chunks in the spool directory. Chunks are
+        renamed into place only once complete, so every file but the manifest
+        and temporary files is a chunk. Their sample rate is not known.
+        """
+        manifest = {}
+        for name in os.listdir(self.directory):
+            path = self.path(name)
+            if name == self.MANIFEST or not os.path.isfile(path):
+                continue
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            manifest[name] = {
+                "sample_rate": None,
+                "size": os.path.getsize(path),
+                "spooled": os.path.getmtime(path),
+            }
+        return manifest
+
+    def write_file(self, name, data):
+        temp = self.path(name + ".tmp")
+        with open(temp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path(name))
+
+    def write_manifest(self):
+        manifest = json.dumps(self.manifest, indent=1, sort_keys=True)
+        self.write_file(self.MANIFEST, manifest.encode())
+
+    def add(self, acquisition_id, sample_rate, data):
+        """Stores chunk data uploaded as acquisition_id at sample_rate"""
+        self.write_file(acquisition_id, data)
+        with self.lock:
+            self.manifest[acquisition_id] = {
+                "sample_rate": sample_rate,
+                "size": len(data),
+                "spooled": time.time(),
+            }
+            self.write_manifest()
+
+    def pending(self):
+        """
+        Returns (acquisition_id, sample_rate) of spooled chunks, oldest first.
+        sample_rate is None if not known.
+        """
+        with self.lock:
+            return [
+                (acquisition_id, entry["sample_rate"])
+                for acquisition_id, entry in sorted(
+                    self.manifest.items(), key=lambda item: item[1]["spooled"]
+                )
+            ]
+
+    def open(self, acquisition_id):
+        return open(self.path(acquisition_id), "rb")
+
+    def remove(self, acquisition_id):
+        with self.lock:
+            self.manifest.pop(acquisition_id, None)
+            self.write_manifest()
+        try:
+            os.remove(self.path(acquisition_id))
+        except OSError:
+            pass
+
+
+class BufferPool(object):
+    """Recycles bytearray buffers of a fixed size"""
+
+    def __init__(self, size):
+        self.size = size
+        self.free = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        return bytearray(self.size)
+
+    def put(self, buffer):
+        with self.lock:
+            self.free.append(buffer)
+
+
+class BoundedExecutor(object):
+    """
+    Thread pool with a bounded queue. submit blocks while all workers are busy
+    and max_pending tasks are queued, applying backpressure to the caller.
+    Keeps track of queue depth and of time tasks spend queued and running.
+    """
+
+    def __init__(self, name, workers=1, max_pending=1):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + max_pending)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self.max_run_time = 0.0
+
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        submitted = time.time()
+        with self.lock:
+            self.in_flight += 1
+
+        def run():
+            started = time.time()
+            try:
+                return fn(*args)
+            except Exception as e:
+                # callers rarely keep the future, so the error would be lost
+                print("{} failed:{}".format(self.name, e), file=sys.stderr)
+                raise
+            finally:
+                finished = time.time()
+                with self.lock:
+                    self.in_flight -= 1
+                    self.completed += 1
+                    self.wait_time += started - submitted
+                    self.run_time += finished - started
+                    self.max_run_time = max(self.max_run_time, finished - started)
+                self.slots.release()
+
+        return self.executor.submit(run)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        with self.lock:
+            n = max(self.completed, 1)
+            return {
+                "stage": self.name,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "mean_wait": self.wait_time / n,
+                "mean_latency": self.run_time / n,
+                "max_latency": self.max_run_time,
+            }
+
+
+class FairExecutor(object):
+    """
+    Thread pool shared by several streams of tasks. Each stream has its own
+    queue of at most max_pending tasks, submit blocking while it is full, and
+    workers take tasks from the streams in turn so that a busy stream cannot
+    starve the others. stream returns a view of one stream with the interface
+    of BoundedExecutor.
+    """
+
+    def __init__(self, name, workers=1, max_pending=1):
+        self.name = name
+        self.max_pending = max_pending
+        self.cond = threading.Condition()
+        self.queues = OrderedDict()
+        self.running = {}
+        self.totals = {}
+        self.ready = deque()
+        self.closed = False
+        self.threads = [threading.Thread(target=self.work) for _ in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stream(self, key):
+        with self.cond:
+            if key not in self.queues:
+                self.queues[key] = deque()
+                self.running[key] = 0
+                # completed, wait, run and max run time
+                self.totals[key] = [0, 0.0, 0.0, 0.0]
+        return FairStream(self, key)
+
+    def submit(self, key, fn, *args):
+        with self.cond:
+            queue = self.queues[key]
+            while len(queue) >= self.max_pending:
+                self.cond.wait()
+            queue.append((fn, args, time.time()))
+            if key not in self.ready:
+                self.ready.append(key)
+            self.cond.notify_all()
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.ready and not self.closed:
+                    self.cond.wait()
+                if not self.ready:
+                    return
+                # take the next task of the stream at the head, and move the
+                # stream to the back if it has more
+                key = self.ready.popleft()
+                fn, args, submitted = self.queues[key].popleft()
+                if self.queues[key]:
+                    self.ready.append(key)
+                self.running[key] += 1
+                self.cond.notify_all()
+            started = time.time()
+            try:
+                fn(*args)
+            except Exception as e:
+                print("{} failed:{}".format(self.name, e), file=sys.stderr)
+            finally:
+                finished = time.time()
+                with self.cond:
+                    self.running[key] -= 1
+                    totals = self.totals[key]
+                    totals[0] += 1
+                    totals[1] += started - submitted
+                    totals[2] += finished - started
+                    totals[3] = max(totals[3], finished - started)
+                    self.cond.notify_all()
+
+    def wait(self, key):
+        """Waits for the tasks of stream key to complete"""
+        with self.cond:
+            while self.queues[key] or self.running[key]:
+                self.cond.wait()
+
+    def stats(self, key):
+        with self.cond:
+            completed, wait_time, run_time, max_run_time = self.totals[key]
+            n = max(completed, 1)
+            return {
+                "stage": self.name,
+                "in_flight": len(self.queues[key]) + self.running[key],
+                "completed": completed,
+                "mean_wait": wait_time / n,
+                "mean_latency": run_time / n,
+                "max_latency": max_run_time,
+            }
+
+    def shutdown(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+
+class FairStream(object):
+    """One stream of tasks of a FairExecutor"""
+
+    def __init__(self, executor, key):
+        self.executor = executor
+        self.key = key
+
+    def submit(self, fn, *args):
+        self.executor.submit(self.key, fn, *args)
+
+    def shutdown(self):
+        self.executor.wait(self.key)
+
+    def stats(self):
+        return self.executor.stats(self.key)
+
+
+class SharedPipeline(object):
+    """
+    Compression and upload workers, compression processes and HTTP session
+    shared by the simulators of several dongles. Each simulator queues at
+    most queue_size chunks per stage, and stages serve simulators in turn.
+    """
+
+    def __init__(
+        self,
+        compress_workers=1,
+        upload_workers=2,
+        queue_size=2,
+        compress_processes=0,
+        streams=1,
+    ):
+        self.compress_pool = FairExecutor(
+            "compress", max(compress_workers, compress_processes), queue_size
+        )
+        self.upload_pool = FairExecutor("upload", upload_workers, queue_size)
+        self.process_pool = None
+        if compress_processes:
+            self.process_pool = ProcessPoolExecutor(compress_processes)
+        # upload workers and a URL prefetching thread per stream
+        self.session = http_session(upload_workers + streams)
+
+    def shutdown(self):
+        self.compress_pool.shutdown()
+        self.upload_pool.shutdown()
+        if self.process_pool:
+            self.process_pool.shutdown()
+
 
 class SatelliteSimulator(object):
     """
@@ -44,6 +544,20 @@ class SatelliteSimulator(object):
         api_url="https://api.myriota.com/v1/spectrum/ingest/",
         id=None,
         url_token=lambda: None,
+        compress_workers=1,
+        upload_workers=2,
+        queue_size=2,
+        stats_interval=0,
+        codec="bz2",
+        level=None,
+        compress_processes=0,
+        dsp="tools",
+        retries=3,
+        backoff=1.0,
+        timeout=60,
+        spool=None,
+        offline=False,
+        shared=None,
     ):
         # endpoint and token for capture upload
         self.api_url = api_url.strip("/")
@@ -60,152 +574,799 @@ class SatelliteSimulator(object):
         self.chunk_duration = chunk_duration
         self.chunk_size = int(self.chunk_duration * self.down_rate * 4)
 
+        # bounded compression and upload stages, see process_capture
+        self.compress_workers = compress_workers
+        self.upload_workers = upload_workers
+        self.queue_size = queue_size
+        self.stats_interval = stats_interval
+        self.compress_pool = None
+        self.upload_pool = None
+
+        # compression codec, run in compress_processes worker processes if
+        # non-zero, otherwise in the compression threads
+        if codec not in CODECS:
+            raise ValueError("Unknown codec {}".format(codec))
+        self.codec = codec
+        self.level = level
+        self.compress_processes = compress_processes
+        self.process_pool = None
+
+        # workers and session shared with the simulators of other dongles
+        self.shared = shared
+
+        # connections kept alive across uploads by all upload workers, and the
+        # thread requesting presigned URLs ahead of time
+        if shared is not None:
+            self.session = shared.session
+        else:
+            self.session = http_session(upload_workers + 1)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.url_pool = None
+        self.prefetched = {}
+        self.prefetch_lock = threading.Lock()
+        # URLs are only requested ahead of time while uploads succeed
+        self.api_reachable = True
+        self.next_end_time = None
+        self.realtime = True
+
+        # chunks that could not be uploaded, or all chunks if offline, are
+        # kept in the spool and uploaded by the drainer thread
+        # spool is a directory, or a Spool shared with other simulators
+        if isinstance(spool, Spool):
+            self.spool = spool
+        else:
+            self.spool = Spool(spool) if spool else None
+        if offline and self.spool is None:
+            raise ValueError("Offline capture requires a spool directory")
+        self.offline = offline
+        self.drain_interval = 30
+        self.drainer = None
+        self.drain_enabled = True
+        self.drain_wake = threading.Event()
+        self.drain_stop = threading.Event()
+
+        # pipeline metrics, reported with the stage statistics and served in
+        # Prometheus text format by serve_metrics
+        self.metrics = Metrics()
+        self.last_report = (self.metrics.start, 0)
+        self.reporter = None
+        self.report_stop = threading.Event()
+
+        # chunks are read in place into buffers recycled once compressed
+        self.buffer_pool = BufferPool(self.chunk_size)
+        self.read_size = 1 << 16
+
+        # sample conversion and resampling by the convert_type and resample
+        # tools, or in process with NumPy
+        if dsp not in ("tools", "numpy"):
+            raise ValueError("Unknown DSP path {}".format(dsp))
+        self.dsp = dsp
+
         # tools convert_type and resample assumed to reside in current folder
         os.environ["PATH"] += os.pathsep + os.getcwd()
 
-    def check_dongle(self):
+    def check_dongle(self, device_index=None):
         """
-        Check if rtl_sdr, convert_type and resample tools are installed and
-        device available. No need to reimplement dongle search as rtl_sdr
-        already does this. Returns True on success.
+        Check if rtl_sdr, convert_type and resample tools (or NumPy for the
+        numpy DSP path) are installed and device available. No need to
+        reimplement dongle search as rtl_sdr already does this. device_index
+        selects one of several dongles. Returns True on success.
         """
         if find_executable("rtl_sdr") is None:
             raise IOError("rtl_sdr: command not found. Please check your installation.")
-        if find_executable("convert_type") is None:
+        if self.dsp == "numpy":
+            try:
+                import myriota_resample
+            except ImportError:
+                raise IOError(
+                    "numpy: module not found. Please check your installation."
+                )
+        elif find_executable("convert_type") is None:
             raise IOError(
                 "convert_type: command not found. Please check your installation."
             )
-        if find_executable("resample") is None:
+        elif find_executable("resample") is None:
             raise IOError(
                 "resample: command not found. Please check your installation."
             )
+        device = "" if device_index is None else "-d {} ".format(device_index)
         proc = subprocess.Popen(
-            "rtl_sdr -n 1 - > /dev/null", shell=True, stderr=subprocess.PIPE
+            "rtl_sdr {}-n 1 - > /dev/null".format(device),
+            shell=True,
+            stderr=subprocess.PIPE,
         )
         _, stderr = proc.communicate()
         if proc.returncode != 0:
             raise IOError(stderr.strip())
         return True
 
-    def start_capture(self, capture_frequency=434e6, capture_gain=33.8, duration=0):
+    def check_codec(self):
+        """
+        Check the compression codec is installed. Returns True on success.
+        """
+        compress(b"", self.codec, self.level)
+        return True
+
+    def start_capture(
+        self, capture_frequency=434e6, capture_gain=33.8, duration=0, device_index=None
+    ):
         """
         Initiate signal capture and processing chain. Samples are written to
-        stdout attribute of the returned subprocess.Popen object. Units of the
-        duration is seconds, with zero corresponding to capturing indefinitely.
+        stdout attribute of the returned subprocess.Popen or Capture object.
+        Units of the duration is seconds, with zero corresponding to capturing
+        indefinitely. device_index selects one of several dongles.
         """
-        cmd = [
-            "rtl_sdr -f {frequency} -s {rate} -g {gain} -n {samples} -",
-            "convert_type -f uint8",
-            "resample -i {rate} -r {down_rate}",
-            "convert_type -t int16",
-        ]
+        cmd = ["rtl_sdr {device}-f {frequency} -s {rate} -g {gain} -n {samples} -"]
+        if self.dsp == "tools":
+            cmd += [
+                "convert_type -f uint8",
+                "resample -i {rate} -r {down_rate}",
+                "convert_type -t int16",
+            ]
         cmd = " | ".join(cmd).format(
             frequency=capture_frequency,
             rate=self.rate,
             gain=capture_gain,
             down_rate=self.down_rate,
             samples=int(duration * self.rate),
+            device="" if device_index is None else "-d {} ".format(device_index),
         )
-        return subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+        capture = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+        if self.dsp == "numpy":
+            from myriota_resample import ResampledStream
 
-    def process_capture(self, capture):
+            stream = ResampledStream(capture.stdout, self.rate, self.down_rate)
+            return Capture(stream, capture)
+        return capture
+
+    def start_replay(self, filename, sample_format="int16", realtime=True):
+        """
+        Replays samples recorded to filename in place of a capture. Samples
+        are either int16 IQ at down_rate, as output by the processing chain,
+        or uint8 IQ at rate, as output by rtl_sdr, which are resampled. If
+        realtime, samples are delivered no faster than they were captured,
+        otherwise as fast as they are read. Returns a Capture object.
         """
-        Reads samples from stdout of the provided subprocess.Popen object
-        capture and splits the stream into chunks. Internally invokes the
-        function process_chunk for each chunk.
+        if sample_format == "int16":
+            stream = MappedFile(filename)
+            if realtime:
+                stream = PacedStream(stream, self.down_rate * 4)
+            return Capture(stream, realtime=realtime)
+        if sample_format != "uint8":
+            raise ValueError("Unknown sample format {}".format(sample_format))
+        if self.dsp == "numpy":
+            from myriota_resample import ResampledStream
 
-        This function does not return until termination of the capture process.
+            stream = MappedFile(filename)
+            if realtime:
+                stream = PacedStream(stream, self.rate * 2)
+            stream = ResampledStream(stream, self.rate, self.down_rate)
+            return Capture(stream, realtime=realtime)
+        cmd = [
+            "convert_type -f uint8",
+            "resample -i {rate} -r {down_rate}",
+            "convert_type -t int16",
+        ]
+        cmd = " | ".join(cmd).format(rate=self.rate, down_rate=self.down_rate)
+        with open(filename, "rb") as f:
+            process = subprocess.Popen(
+                cmd,
+                shell=True,
+                stdin=f,
+                stdout=subprocess.PIPE,
+            )
+        stream = process.stdout
+        if realtime:
+            stream = PacedStream(stream, self.down_rate * 4)
+        return Capture(stream, process, realtime)
+
+    def start_pipeline(self):
         """
-        chunk = BytesIO()
-        threads = []
-        while True:
-            returncode = capture.poll()
-            if returncode == None:
-                buffer = capture.stdout.read(64)
-                while len(buffer) >= self.chunk_size - chunk.tell():
-                    bytes = self.chunk_size - chunk.tell()
-                    chunk.write(buffer[0:bytes])
-                    t = Thread(target=self.process_chunk, args=[chunk])
-                    threads.append(t)
-                    t.start()
-                    # remove written portion from buffer, then move on to next chunk
-                    buffer = buffer[bytes:]
-                    chunk = BytesIO()
-                chunk.write(buffer)
-            elif returncode == 0:
-                # capture process completed successfully -> process remaining samples
-                buffer = capture.stdout.read()
-                while len(buffer) >= self.chunk_size - chunk.tell():
-                    bytes = self.chunk_size - chunk.tell()
-                    chunk.write(buffer[0:bytes])
-                    t = Thread(target=self.process_chunk, args=[chunk])
-                    threads.append(t)
-                    t.start()
-                    # remove written portion from buffer, then move on to next chunk
-                    buffer = buffer[bytes:]
-                    chunk = BytesIO()
-                chunk.write(buffer)
-                if chunk.tell() > 0:
-                    t = Thread(target=self.process_chunk, args=[chunk])
-                    threads.append(t)
-                    t.start()
-                break
+        Creates the compression and upload stages, each a pool of workers
+        with a queue of at most queue_size chunks, or a stream of the shared
+        pools.
+        """
+        if self.shared is not None:
+            self.compress_pool = self.shared.compress_pool.stream(self.id)
+            self.upload_pool = self.shared.upload_pool.stream(self.id)
+            self.process_pool = self.shared.process_pool
+        elif self.compress_processes:
+            self.process_pool = ProcessPoolExecutor(self.compress_processes)
+        if self.shared is None:
+            # a compression thread waits on each chunk compressed by a process
+            self.compress_pool = BoundedExecutor(
+                "compress",
+                max(self.compress_workers, self.compress_processes),
+                self.queue_size,
+            )
+            self.upload_pool = BoundedExecutor(
+                "upload", self.upload_workers, self.queue_size
+            )
+        self.url_pool = ThreadPoolExecutor(1)
+        self.next_end_time = None
+        if self.spool is not None and not self.offline and self.drain_enabled:
+            self.drain_stop.clear()
+            self.drainer = threading.Thread(target=self.drain_loop)
+            self.drainer.daemon = True
+            self.drainer.start()
+        # statistics are reported on time even while the capture stalls
+        if self.stats_interval:
+            self.report_stop.clear()
+            self.reporter = threading.Thread(target=self.report_loop)
+            self.reporter.daemon = True
+            self.reporter.start()
+
+    def finish_pipeline(self):
+        """Waits for queued chunks to be compressed and uploaded"""
+        self.compress_pool.shutdown()
+        if self.process_pool and self.shared is None:
+            self.process_pool.shutdown()
+        self.process_pool = None
+        self.upload_pool.shutdown()
+        self.url_pool.shutdown()
+        self.prefetched.clear()
+        if self.reporter is not None:
+            self.report_stop.set()
+            self.reporter.join()
+            self.reporter = None
+        if self.drainer is not None:
+            self.drain_stop.set()
+            self.drain_wake.set()
+            self.drainer.join()
+            self.drainer = None
+
+    def pipeline_stats(self):
+        """Returns queue depth and latency statistics of each stage"""
+        return [p.stats() for p in (self.compress_pool, self.upload_pool) if p]
+
+    def report_stats(self):
+        # simulators sharing a process tell their reports apart by ID
+        label = "{}: ".format(self.id) if self.shared is not None else ""
+        for stats in self.pipeline_stats():
+            print(
+                label + "{stage}: {in_flight} in flight, {completed} done, "
+                "wait {mean_wait:.2f}s, latency {mean_latency:.2f}s "
+                "(max {max_latency:.2f}s)".format(**stats),
+                file=sys.stderr,
+            )
+        for line in self.metrics_summary():
+            print(label + line, file=sys.stderr)
+
+    def report_loop(self):
+        """Reports pipeline statistics every stats_interval seconds"""
+        while not self.report_stop.wait(self.stats_interval):
+            self.report_stats()
+
+    def metrics_summary(self):
+        """Returns lines summarising pipeline metrics since the last summary"""
+        now = time.time()
+        counters = self.metrics.snapshot()
+        last_time, last_bytes = self.last_report
+        self.last_report = (now, counters["bytes_read"])
+        # int16 IQ samples are 4 bytes
+        rate = (counters["bytes_read"] - last_bytes) / 4.0 / max(now - last_time, 1e-9)
+        in_flight = sum(stats["in_flight"] for stats in self.pipeline_stats())
+        ratio = counters["compressed_bytes"] / float(max(counters["raw_bytes"], 1))
+
+        def latency(name):
+            ps = self.metrics.percentiles(name)
+            if ps[0] is None:
+                return "{} -".format(name)
+            return "{} p50 {:.3f}s p90 {:.3f}s p99 {:.3f}s".format(name, *ps)
+
+        return [
+            "samples: {:.0f}/s ({:.2f}x real time), {} chunks in flight".format(
+                rate, rate / self.down_rate, in_flight
+            ),
+            "compression: ratio {:.3f}, {}".format(ratio, latency("compress")),
+            "requests: {}, {}".format(latency("url"), latency("put")),
+            "chunks: {chunks_uploaded} uploaded, {chunks_failed} failed, "
+            "{chunks_spooled} spooled, {chunks_dropped} dropped, "
+            "{spool_uploaded} uploaded from spool".format(**counters),
+        ]
+
+    def prometheus_metrics(self):
+        """Returns pipeline metrics in the Prometheus text exposition format"""
+        return prometheus_metrics([self])
+
+    def serve_metrics(self, port, host="", simulators=None):
+        """
+        Serves the Prometheus metrics of simulators, by default this one, at
+        /metrics on port from a background thread. Returns the HTTP server.
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        simulators = simulators or [self]
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = prometheus_metrics(simulators).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def submit_chunk(self, buffer, length):
+        """
+        Queues the first length bytes of buffer, taken from buffer_pool, for
+        compression and upload. Blocks while the compression queue is full.
+        """
+        end_time = self.chunk_end_time()
+        self.compress_pool.submit(self.compress_stage, buffer, length, end_time)
+
+    def chunk_end_time(self):
+        """
+        Returns the end time of the chunk just read, and requests the upload
+        URL of the next chunk. Consecutive chunks hold consecutive samples, so
+        the next chunk is expected to end chunk_duration later. That expected
+        time is used when it is close to the time the chunk is read, within a
+        tenth of chunk_duration and at most a second, to upload to the URL
+        requested ahead of time. Samples replayed faster than real time
+        always take the expected time, keeping acquisition IDs distinct.
+        """
+        now = self.get_time()
+        expected = self.next_end_time
+        tolerance = min(1.0, self.chunk_duration / 10.0)
+        if expected is not None and (
+            not self.realtime or abs(now - expected) <= tolerance
+        ):
+            end_time = expected
+        else:
+            end_time = now
+            if expected is not None:
+                self.discard_prefetched(expected)
+        self.next_end_time = end_time + self.chunk_duration
+        if not self.offline and self.api_reachable:
+            self.prefetch_url(self.next_end_time)
+        return end_time
+
+    def prefetch_url(self, end_time):
+        """Requests the presigned URL of a chunk ending at end_time"""
+        future = self.url_pool.submit(self.upload_url, end_time)
+        with self.prefetch_lock:
+            self.prefetched[end_time] = future
+
+    def discard_prefetched(self, end_time):
+        """Forgets the presigned URL of a chunk ending at end_time, if any"""
+        with self.prefetch_lock:
+            future = self.prefetched.pop(end_time, None)
+        if future is not None:
+            future.cancel()
+
+    def prefetched_url(self, end_time):
+        """
+        Returns the presigned URL of a chunk ending at end_time if it was
+        requested ahead of time, otherwise None.
+        """
+        with self.prefetch_lock:
+            future = self.prefetched.pop(end_time, None)
+        if future is not None:
+            try:
+                return future.result()
+            except requests.RequestException as e:
+                print("Presigned URL request failed:" + str(e), file=sys.stderr)
+                self.api_reachable = False
+        return None
+
+    def compress_stage(self, buffer, length, end_time):
+        start = time.time()
+        try:
+            compressed = self.compress_data(memoryview(buffer)[:length])
+        except Exception as e:
+            # tell the user if compression fails, but attempt to keep going
+            print("Compression failed:" + str(e), file=sys.stderr)
+            self.metrics.count("chunks_dropped")
+            self.discard_prefetched(end_time)
+            return
+        finally:
+            self.buffer_pool.put(buffer)
+        self.metrics.observe("compress", time.time() - start)
+        self.metrics.count("raw_bytes", length)
+        self.metrics.count("compressed_bytes", len(compressed))
+        self.upload_pool.submit(self.upload_stage, BytesIO(compressed), end_time)
+
+    def upload_stage(self, chunk, end_time=None):
+        if end_time is None:
+            end_time = self.get_time()
+        try:
+            if self.offline:
+                spooled = self.spool_chunk(chunk, end_time)
+                self.metrics.count("chunks_spooled" if spooled else "chunks_dropped")
+            else:
+                self.upload_chunk(chunk, end_time)
+                self.metrics.count("chunks_uploaded")
+                self.api_reachable = True
+                if self.spool:
+                    # the API is reachable, upload any spooled chunks
+                    self.drain_wake.set()
+        except Exception as e:
+            # tell the user if upload fails, but attempt to keep going
+            print("Upload failed:" + str(e), file=sys.stderr)
+            self.metrics.count("chunks_failed")
+            self.api_reachable = False
+            if self.spool is not None and self.spool_chunk(chunk, end_time):
+                self.metrics.count("chunks_spooled")
+            else:
+                self.metrics.count("chunks_dropped")
+        finally:
+            # a URL requested for a chunk spooled or dropped is never used
+            self.discard_prefetched(end_time)
+            chunk.close()
+
+    def spool_chunk(self, chunk, end_time):
+        """
+        Keeps a chunk ending at end_time in the spool for later upload.
+        Returns True on success.
+        """
+        chunk.seek(0)
+        acquisition_id = self.acquisition_id(end_time)
+        try:
+            self.spool.add(acquisition_id, self.down_rate, chunk.read())
+        except (IOError, OSError) as e:
+            print("Spooling failed:" + str(e), file=sys.stderr)
+            return False
+        return True
+
+    def drain_loop(self):
+        """Uploads spooled chunks when woken, or every drain_interval seconds"""
+        while not self.drain_stop.is_set():
+            self.drain_wake.wait(self.drain_interval)
+            self.drain_wake.clear()
+            if len(self.spool) and not self.drain_stop.is_set():
+                self.drain_spool()
+
+    def drain_spool(self):
+        """
+        Uploads spooled chunks, upload_workers at a time, removing each from
+        the spool once uploaded. Stops at the first failure, the API being
+        likely unreachable. Returns the number of chunks uploaded and failed.
+        """
+        pool = BoundedExecutor("drain", self.upload_workers, self.queue_size)
+        uploaded = []
+        failed = []
+
+        def upload(acquisition_id, sample_rate):
+            if failed or self.drain_stop.is_set():
+                return
+            # the sample rate of chunks in a rebuilt manifest is not known
+            if sample_rate is None:
+                sample_rate = self.down_rate
+            try:
+                with self.spool.open(acquisition_id) as chunk:
+                    self.put_chunk(chunk, acquisition_id, sample_rate)
+            except Exception as e:
+                print("Spooled upload failed:" + str(e), file=sys.stderr)
+                failed.append(acquisition_id)
             else:
+                self.spool.remove(acquisition_id)
+                uploaded.append(acquisition_id)
+                self.metrics.count("spool_uploaded")
+                self.api_reachable = True
+
+        try:
+            for acquisition_id, sample_rate in self.spool.pending():
+                if failed or self.drain_stop.is_set():
+                    break
+                pool.submit(upload, acquisition_id, sample_rate)
+        finally:
+            pool.shutdown()
+        return len(uploaded), len(failed)
+
+    def read_chunk(self, stream, buffer):
+        """
+        Fills buffer from stream with readinto, without intermediate copies.
+        Returns the number of bytes read, less than the buffer size only at
+        the end of the stream.
+        """
+        view = memoryview(buffer)
+        filled = 0
+        while filled < len(buffer):
+            n = stream.readinto(view[filled : filled + self.read_size])
+            if not n:
+                break
+            filled += n
+            self.metrics.count("bytes_read", n)
+        return filled
+
+    def process_capture(self, capture):
+        """
+        Reads samples from stdout of the provided subprocess.Popen or Capture
+        object capture and splits the stream into chunks. Chunks are compressed and
+        uploaded by bounded worker pools, and reading stalls while they are
+        saturated.
+
+        This function does not return until termination of the capture process
+        and upload of all chunks.
+        """
+        self.realtime = getattr(capture, "realtime", True)
+        self.start_pipeline()
+        try:
+            while True:
+                buffer = self.buffer_pool.get()
+                length = self.read_chunk(capture.stdout, buffer)
+                if length < len(buffer):
+                    break
+                self.submit_chunk(buffer, length)
+            returncode = capture.wait()
+            if returncode != 0:
+                self.buffer_pool.put(buffer)
                 raise IOError(
                     "Error: signal capture terminated with exit code {}.".format(
                         returncode
                     )
                 )
-            # clear out finished threads
-            threads = [t for t in threads if t.is_alive()]
-        # wait for remaining threads to finished
-        [t.join() for t in threads]
+            # capture process completed successfully -> process remaining samples
+            if length > 0:
+                self.submit_chunk(buffer, length)
+            else:
+                self.buffer_pool.put(buffer)
+        finally:
+            # wait for queued chunks to be processed
+            self.finish_pipeline()
+        if self.stats_interval:
+            self.report_stats()
 
-    def process_chunk(self, chunk):
+    def compress_data(self, data):
         """
-        Compresses a chunk of samples with bzip2. Internally invokes function
-        upload_chunk.
+        Returns data, any object supporting the buffer protocol, compressed
+        with the configured codec.
+        """
+        if self.process_pool:
+            # memoryviews cannot be pickled, sending to a process copies anyway
+            future = self.process_pool.submit(
+                compress, bytes(data), self.codec, self.level
+            )
+            return future.result()
+        return compress(data, self.codec, self.level)
+
+    def compress_chunk(self, chunk):
+        """
+        Compresses a chunk of samples with the configured codec, in place.
         """
         chunk.seek(0)
-        compressed = bz2.compress(chunk.read(), 9)
+        compressed = self.compress_data(chunk.read())
         chunk.seek(0)
         chunk.write(compressed)
         chunk.truncate()
-        try:
-            self.upload_chunk(chunk)
-        except Exception as e:
-            # tell the user if upload fails, but attempt to keep going
-            print("Upload failed:" + str(e), file=sys.stderr)
-        finally:
-            chunk.close()
 
-    def upload_chunk(self, chunk):
+    def process_chunk(self, chunk):
         """
-        Uploads the provided chunk of samples to a presigned URL.
+        Compresses a chunk of samples. Internally invokes function
+        upload_chunk.
+        """
+        self.compress_chunk(chunk)
+        self.upload_stage(chunk)
+
+    def upload_chunk(self, chunk, end_time=None):
+        """
+        Uploads the provided chunk of samples to a presigned URL. end_time is
+        the time capture of the chunk completed, by default now.
+        """
+        if end_time is None:
+            end_time = self.get_time()
+        self.put_chunk(
+            chunk,
+            self.acquisition_id(end_time),
+            self.down_rate,
+            self.prefetched_url(end_time),
+        )
+
+    def put_chunk(self, chunk, acquisition_id, sample_rate, upload_url=None):
+        """
+        Uploads chunk, a file object, as acquisition_id to upload_url or to a
+        newly requested presigned URL. Failed uploads are retried up to
+        retries times to a new URL, waiting backoff seconds, doubled on each
+        retry.
         """
-        upload_url = self.upload_url()
-        chunk.seek(0)
         headers = {"Content-Type": ""}
-        upload = requests.put(upload_url, headers=headers, data=chunk)
-        upload.raise_for_status()
+        for attempt in range(self.retries + 1):
+            try:
+                if upload_url is None or attempt > 0:
+                    upload_url = self.request_url(acquisition_id, sample_rate)
+                chunk.seek(0)
+                start = time.time()
+                upload = self.session.put(
+                    upload_url, headers=headers, data=chunk, timeout=self.timeout
+                )
+                self.metrics.observe("put", time.time() - start)
+                upload.raise_for_status()
+                return
+            except requests.RequestException as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2**attempt
+                print(
+                    "Upload failed:{}, retrying in {:g}s".format(e, delay),
+                    file=sys.stderr,
+                )
+                time.sleep(delay)
 
     def get_time(self):
         return time.time()
 
-    def upload_url(self):
+    def acquisition_id(self, end_time):
+        """Returns the acquisition ID of a chunk whose capture ended at end_time"""
+        # timestamp with 100 µs resolution, backdated by the duration of the chunk
+        timestamp = int((end_time - self.chunk_duration) * 1e4)
+        return "{id}_{ts}{ext}".format(
+            id=self.id, ts=timestamp, ext=CODECS[self.codec][0]
+        )
+
+    def upload_url(self, end_time=None):
         """
-        Returns a presigned URL for uploading a chunk of samples.
+        Returns a presigned URL for uploading a chunk of samples whose capture
+        completed at end_time, by default now.
+        """
+        if end_time is None:
+            end_time = self.get_time()
+        return self.request_url(self.acquisition_id(end_time), self.down_rate)
+
+    def request_url(self, acquisition_id, sample_rate):
+        """
+        Returns a presigned URL for uploading a chunk of samples at
+        sample_rate as acquisition_id.
         """
-        # timestamp with 100 µs resolution, backdated by the duration of the chunk
-        timestamp = int((self.get_time() - self.chunk_duration) * 1e4)
-        acquisition_id = "{id}_{ts}.bz2".format(id=self.id, ts=timestamp)
         auth_header = {"Authorization": "{token}".format(token=self.url_token())}
-        get_params = {"AcqID": acquisition_id, "sample-rate": str(self.down_rate)}
-        destination = requests.get(self.api_url, headers=auth_header, params=get_params)
+        get_params = {"AcqID": acquisition_id, "sample-rate": str(sample_rate)}
+        start = time.time()
+        destination = self.session.get(
+            self.api_url, headers=auth_header, params=get_params, timeout=self.timeout
+        )
+        self.metrics.observe("url", time.time() - start)
         destination.raise_for_status()
         return destination.text
 
 
+def process_captures(simulators, captures):
+    """
+    Runs process_capture of each simulator on the matching capture, all
+    concurrently. Returns a dict of the exception raised by each simulator
+    that failed, keyed by simulator ID.
+    """
+    errors = {}
+
+    def run(simulator, capture):
+        try:
+            simulator.process_capture(capture)
+        except Exception as e:
+            errors[simulator.id] = e
+
+    threads = [
+        threading.Thread(target=run, args=(simulator, capture))
+        for simulator, capture in zip(simulators, captures)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def parse_dongle(text, gain):
+    """
+    Parses INDEX:FREQUENCY[:GAIN[:ID]] into a dict with device_index,
+    frequency, gain and id, gain defaulting to gain.
+    """
+    fields = text.split(":")
+    if not 2 <= len(fields) <= 4:
+        raise ValueError("Dongle {} is not INDEX:FREQUENCY[:GAIN[:ID]]".format(text))
+    return {
+        "device_index": int(fields[0]),
+        "frequency": float(fields[1]),
+        "gain": float(fields[2]) if len(fields) > 2 and fields[2] else gain,
+        "id": fields[3] if len(fields) > 3 else None,
+    }
+
+
+def prometheus_metrics(simulators):
+    """
+    Returns the pipeline metrics of simulators in the Prometheus text
+    exposition format, labelled with the simulator ID.
+    """
+    prefix = "myriota_simulator_"
+    snapshots = [(simulator, simulator.metrics.snapshot()) for simulator in simulators]
+    lines = []
+
+    def metric(name, kind, help, samples):
+        # samples(simulator, counters) returns (labels, value) pairs
+        lines.append("# HELP {}{} {}".format(prefix, name, help))
+        lines.append("# TYPE {}{} {}".format(prefix, name, kind))
+        for simulator, counters in snapshots:
+            for labels, value in samples(simulator, counters):
+                labels = ['simulator="{}"'.format(simulator.id)] + labels
+                lines.append(
+                    "{}{}{{{}}} {}".format(prefix, name, ",".join(labels), value)
+                )
+
+    metric(
+        "samples_read_total",
+        "counter",
+        "IQ samples read from the capture.",
+        lambda simulator, counters: [([], counters["bytes_read"] // 4)],
+    )
+    metric(
+        "sample_rate",
+        "gauge",
+        "Expected IQ samples per second.",
+        lambda simulator, counters: [([], simulator.down_rate)],
+    )
+    metric(
+        "chunks_in_flight",
+        "gauge",
+        "Chunks queued or being processed by each stage.",
+        lambda simulator, counters: [
+            (['stage="{}"'.format(stats["stage"])], stats["in_flight"])
+            for stats in simulator.pipeline_stats()
+        ],
+    )
+    metric(
+        "raw_bytes_total",
+        "counter",
+        "Bytes of samples compressed.",
+        lambda simulator, counters: [([], counters["raw_bytes"])],
+    )
+    metric(
+        "compressed_bytes_total",
+        "counter",
+        "Bytes of compressed chunks.",
+        lambda simulator, counters: [([], counters["compressed_bytes"])],
+    )
+    metric(
+        "chunks_total",
+        "counter",
+        "Chunks by outcome.",
+        lambda simulator, counters: [
+            (['result="{}"'.format(result)], counters["chunks_" + result])
+            for result in ["uploaded", "failed", "spooled", "dropped"]
+        ]
+        + [(['result="uploaded_from_spool"'], counters["spool_uploaded"])],
+    )
+    metric(
+        "spool_chunks",
+        "gauge",
+        "Chunks waiting in the spool.",
+        lambda simulator, counters: (
+            [([], len(simulator.spool))] if simulator.spool is not None else []
+        ),
+    )
+    for name, help in [
+        ("compress", "Seconds compressing a chunk."),
+        ("url", "Seconds requesting a presigned URL."),
+        ("put", "Seconds uploading a chunk."),
+    ]:
+
+        def samples(simulator, counters):
+            ps = simulator.metrics.percentiles(name, (50, 90, 99))
+            return [
+                (['quantile="0.{}"'.format(p)], value)
+                for p, value in zip((5, 9, 99), ps)
+                if value is not None
+            ]
+
+        metric(name + "_seconds", "summary", help, samples)
+        for simulator, counters in snapshots:
+            total, count = simulator.metrics.totals[name]
+            label = '{{simulator="{}"}}'.format(simulator.id)
+            lines.append("{}{}_seconds_sum{} {}".format(prefix, name, label, total))
+            lines.append("{}{}_seconds_count{} {}".format(prefix, name, label, count))
+    return "\n".join(lines) + "\n"
+
+
 class SatelliteSimulatorAuth(SatelliteSimulator):
     """Myriota Development Kit satellite simulator with user authentication."""
 
@@ -238,6 +1399,62 @@ class SatelliteSimulatorAuth(SatelliteSimulator):
         return True
 
 
+class _ChunkerBenchmark(SatelliteSimulator):
+    """Simulator with compression and upload stubbed out"""
+
+    def compress_data(self, data):
+        return b""
+
+    def upload_chunk(self, chunk, end_time=None):
+        pass
+
+    def upload_url(self, end_time=None):
+        return ""
+
+    def legacy_process_capture(self, capture):
+        # chunker used before buffers were read in place: 64 byte reads
+        # sliced into BytesIO chunks
+        chunk = BytesIO()
+        while True:
+            buffer = capture.stdout.read(64)
+            if not buffer:
+                break
+            while len(buffer) >= self.chunk_size - chunk.tell():
+                bytes = self.chunk_size - chunk.tell()
+                chunk.write(buffer[0:bytes])
+                self.process_chunk(chunk)
+                buffer = buffer[bytes:]
+                chunk = BytesIO()
+            chunk.write(buffer)
+        capture.wait()
+
+
+def benchmark_chunker(minutes):
+    """
+    Prints CPU time spent splitting minutes of captured samples into chunks,
+    comparing the legacy chunker with the in place one.
+    """
+    simulator = _ChunkerBenchmark(upload_workers=1)
+    size = int(minutes * simulator.chunk_size * 60 / simulator.chunk_duration)
+    cases = [
+        ("64 byte reads", simulator.legacy_process_capture),
+        ("readinto", simulator.process_capture),
+    ]
+    print("Chunking {} minutes ({} bytes) of samples".format(minutes, size))
+    for name, process in cases:
+        capture = subprocess.Popen(
+            ["head", "-c", str(size), "/dev/zero"], stdout=subprocess.PIPE
+        )
+        start = time.process_time()
+        process(capture)
+        cpu = time.process_time() - start
+        print(
+            "{:16} {:8.3f}s CPU, {:8.4f}s per captured minute".format(
+                name, cpu, cpu / minutes
+            )
+        )
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -253,19 +1470,234 @@ if __name__ == "__main__":
         "-f", "--frequency", type=float, default=434e6, help="Capture frequency."
     )
     parser.add_argument("-g", "--gain", type=float, default=33.8, help="Capture gain.")
+    parser.add_argument(
+        "--compress-workers",
+        type=int,
+        default=1,
+        help="Number of threads compressing chunks.",
+    )
+    parser.add_argument(
+        "--upload-workers",
+        type=int,
+        default=2,
+        help="Number of threads uploading chunks.",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=2,
+        help="Chunks queued per stage before capture reading is paused.",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=0,
+        help="Seconds between pipeline metrics reports on stderr, zero to disable.",
+    )
+
+    parser.add_argument(
+        "--codec",
+        choices=sorted(CODECS),
+        default="bz2",
+        help="Compression codec of uploaded chunks.",
+    )
+    parser.add_argument(
+        "--level",
+        type=int,
+        help="Compression level, by default 9 for bz2, 3 for zstd and 0 for lz4.",
+    )
+    parser.add_argument(
+        "--compress-processes",
+        type=int,
+        default=0,
+        help="Number of processes compressing chunks, zero to compress in threads.",
+    )
+    parser.add_argument(
+        "--dsp",
+        choices=["tools", "numpy"],
+        default="tools",
+        help="Resample with the convert_type and resample tools, or in process with NumPy.",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Number of times a failed upload is retried.",
+    )
+    parser.add_argument(
+        "--backoff",
+        type=float,
+        default=1.0,
+        help="Seconds before the first retry of a failed upload, doubled on each retry.",
+    )
+    parser.add_argument(
+        "--api-url",
+        default="https://api.myriota.com/v1/spectrum/ingest/",
+        help="Endpoint issuing presigned upload URLs.",
+    )
+    parser.add_argument(
+        "--spool",
+        metavar="DIR",
+        help="Keep chunks that fail to upload in DIR, and upload them once the API is reachable.",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Capture without uploading, keeping all chunks in the spool.",
+    )
+    parser.add_argument(
+        "--upload-spool",
+        action="store_true",
+        help="Upload the chunks kept in the spool and exit.",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve pipeline metrics in Prometheus text format at /metrics on this port.",
+    )
+    parser.add_argument(
+        "--dongle",
+        action="append",
+        metavar="INDEX:FREQUENCY[:GAIN[:ID]]",
+        help="Capture with dongle INDEX at FREQUENCY, and GAIN and simulator ID if "
+        "given. Repeat for each of several dongles, which share authentication, "
+        "workers and connections.",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="FILE",
+        help="Replay samples recorded to FILE instead of capturing with the dongle.",
+    )
+    parser.add_argument(
+        "--replay-format",
+        choices=["int16", "uint8"],
+        default="int16",
+        help="Format of replayed samples, int16 after resampling or uint8 from rtl_sdr.",
+    )
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        help="Replay samples as fast as possible rather than at the capture rate.",
+    )
+    parser.add_argument(
+        "--benchmark-chunker",
+        type=float,
+        metavar="MINUTES",
+        help="Measure CPU time of chunking MINUTES of samples and exit.",
+    )
 
     args = parser.parse_args()
 
-    simulator = SatelliteSimulatorAuth()
+    if args.benchmark_chunker:
+        benchmark_chunker(args.benchmark_chunker)
+        sys.exit()
+    if (args.offline or args.upload_spool) and not args.spool:
+        parser.error("--offline and --upload-spool require --spool")
+
+    options = dict(
+        compress_workers=args.compress_workers,
+        upload_workers=args.upload_workers,
+        queue_size=args.queue_size,
+        stats_interval=args.stats_interval,
+        codec=args.codec,
+        level=args.level,
+        compress_processes=args.compress_processes,
+        dsp=args.dsp,
+        retries=args.retries,
+        backoff=args.backoff,
+        api_url=args.api_url,
+        offline=args.offline,
+    )
     try:
-        simulator.check_dongle()
-        simulator.login()
-        capture = simulator.start_capture(
-            capture_frequency=args.frequency,
-            capture_gain=args.gain,
-            duration=args.duration,
+        dongles = [parse_dongle(dongle, args.gain) for dongle in args.dongle or []]
+    except ValueError as e:
+        parser.error(e)
+    if dongles and args.replay:
+        parser.error("--dongle and --replay are exclusive")
+
+    if dongles:
+        # the first simulator authenticates for all of them, the spool is
+        # drained by the first only
+        shared = SharedPipeline(
+            args.compress_workers,
+            args.upload_workers,
+            args.queue_size,
+            args.compress_processes,
+            streams=len(dongles),
         )
+        spool = Spool(args.spool) if args.spool else None
+        simulator = SatelliteSimulatorAuth(
+            id=dongles[0]["id"], shared=shared, spool=spool, **options
+        )
+        simulators = [simulator] + [
+            SatelliteSimulator(
+                id=dongle["id"],
+                url_token=simulator.url_token,
+                shared=shared,
+                spool=spool,
+                **options
+            )
+            for dongle in dongles[1:]
+        ]
+        for other in simulators[1:]:
+            other.drain_enabled = False
+    else:
+        simulator = SatelliteSimulatorAuth(spool=args.spool, **options)
+        simulators = [simulator]
+    try:
+        simulator.check_codec()
+        if args.upload_spool:
+            simulator.login()
+            uploaded, failed = simulator.drain_spool()
+            print(
+                "Uploaded {} chunks, {} remaining in spool.".format(
+                    uploaded, len(simulator.spool)
+                )
+            )
+            sys.exit(1 if failed else 0)
+        if dongles:
+            for dongle in dongles:
+                simulator.check_dongle(dongle["device_index"])
+        elif not args.replay:
+            simulator.check_dongle()
+        if not args.offline:
+            simulator.login()
+        if args.metrics_port:
+            simulator.serve_metrics(args.metrics_port, simulators=simulators)
+        if dongles:
+            captures = [
+                other.start_capture(
+                    capture_frequency=dongle["frequency"],
+                    capture_gain=dongle["gain"],
+                    duration=args.duration,
+                    device_index=dongle["device_index"],
+                )
+                for other, dongle in zip(simulators, dongles)
+            ]
+            errors = process_captures(simulators, captures)
+            shared.shutdown()
+            for id, error in errors.items():
+                print("{}: {}".format(id, error), file=sys.stderr)
+            if errors:
+                sys.exit(1)
+            sys.exit()
+        if args.replay:
+            capture = simulator.start_replay(
+                args.replay, args.replay_format, realtime=not args.fast
+            )
+        else:
+            capture = simulator.start_capture(
+                capture_frequency=args.frequency,
+                capture_gain=args.gain,
+                duration=args.duration,
+            )
+        start = time.time()
         simulator.process_capture(capture)
+        if args.replay:
+            print(
+                "Replayed {} in {:.2f}s".format(args.replay, time.time() - start),
+                file=sys.stderr,
+            )
     except KeyboardInterrupt as e:
         sys.exit(e)
     except Exception as e:
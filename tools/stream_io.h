@@ -0,0 +1,40 @@
+// Copyright (c) 2021, Myriota Pty Ltd, All Rights Reserved
+// SPDX-License-Identifier: BSD-3-Clause-Attribution
+//
+// This file is licensed under the BSD with attribution  (the "License"); you
+// may not use these files except in compliance with the License.
+//
+// You may obtain a copy of the License here:
+// LICENSE-BSD-3-Clause-Attribution.txt and at
+// https://spdx.org/licenses/BSD-3-Clause-Attribution.html
+//
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#ifndef STREAM_IO_H
+#define STREAM_IO_H
+
+#include <errno.h>
+#include <stdio.h>
+#include <unistd.h>
+
+// read up to count elements of size bytes from file into buf, returning as
+// soon as whole elements are available instead of waiting for all count, so
+// that samples arriving slowly over a pipe are passed on without delay.
+// Reads the file descriptor directly, so must not be mixed with stdio reads
+// of file. Returns the number of elements read, 0 at end of file or on error.
+static inline size_t read_available(FILE *file, void *buf, size_t size,
+                                    size_t count) {
+  const int fd = fileno(file);
+  char *p = static_cast<char *>(buf);
+  size_t got = 0;
+  while (got == 0 || got % size) {
+    const ssize_t n = read(fd, p + got, size * count - got);
+    if (n < 0 && errno == EINTR) continue;
+    if (n <= 0) break;  // a trailing partial element is dropped, as by fread
+    got += n;
+  }
+  return got / size;
+}
+
+#endif
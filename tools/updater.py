@@ -20,15 +20,21 @@ import time
 import serial
 import serial.tools.list_ports
 import argparse
+import errno
+import json
 import os
 import struct
-import tempfile
-from io import BytesIO
+import mmap
+import myriota_crc
 import signal
 import sys
+import threading
 
 version = "1.1"
 
+# os.replace is only available in Python 3, rename also replaces on POSIX
+replace_file = getattr(os, "replace", os.rename)
+
 
 def get_ports():
     ports = set()
@@ -66,8 +72,7 @@ def open_serial_port(portname, baudrate):
             timeout=0.5,
         )
     except (OSError, serial.SerialException):
-        sys.stderr.write("Failed to open %s\n" % portname)
-        sys.exit(1)
+        raise IOError("Failed to open %s" % portname)
     return ser
 
 
@@ -90,7 +95,11 @@ def wait_for_serial_port(portname, baudrate):
             pass
 
 
-def capture_bootloader(ser):
+def capture_bootloader(ser, prompt=None):
+    """
+    Captures the bootloader on ser, asking for the device to be reset on
+    stdout, or through prompt if given. Raises IOError if it never responds.
+    """
     # return straightaway if already in bootloader
     ser.reset_input_buffer()
     ser.write(b"U")
@@ -103,8 +112,11 @@ def capture_bootloader(ser):
         ser.readline()
         ser.readline()
         return
-    print("Please reset the device", end="")
-    sys.stdout.flush()
+    if prompt is None:
+        print("Please reset the device", end="")
+        sys.stdout.flush()
+    else:
+        prompt("please reset the device")
     ser.reset_input_buffer()
 
     # Try to capture the bootloader
@@ -116,7 +128,8 @@ def capture_bootloader(ser):
         line = ser.readline()
         out = line
         if b"Bootloader" in line:
-            print("\n")
+            if prompt is None:
+                print("\n")
             ser.readline()
             ser.readline()
             ser.readline()
@@ -128,44 +141,37 @@ def capture_bootloader(ser):
                 break
         retries += 1
         if retries > MAX_RETRIES:
-            sys.stderr.write("failed to connect to the board\n")
-            sys.exit(1)
+            raise IOError("failed to connect to the board")
         time.sleep(0.5)
-        print(".", end="")
-        sys.stdout.flush()
+        if prompt is None:
+            print(".", end="")
+            sys.stdout.flush()
 
     ser.reset_input_buffer()
 
 
-def _bytecrc(crc, poly, n):
-    mask = 1 << (n - 1)
-    for i in range(8):
-        if crc & mask:
-            crc = (crc << 1) ^ poly
-        else:
-            crc = crc << 1
-    mask = (1 << n) - 1
-    crc = crc & mask
-    return crc
+def is_stream(image):
+    return hasattr(image, "read")
 
 
-def calc_crc(data):
-    poly = 0x11021
-    bit_size = 16
-    table = [_bytecrc(i << (bit_size - 8), poly, bit_size) for i in range(256)]
-    crc = 0
-    for b in data:
-        crc = table[b ^ ((crc >> 8) & 0xFF)] ^ ((crc << 8) & 0xFF00)
-    return crc
+XMODEM_BLOCK_SIZE = 128
+XMODEM_1K_BLOCK_SIZE = 1024
 
 
-def xmodem_send(serial, file, ncg, quiet=True):
-    SOH = bytes(bytearray([0x01]))
+def xmodem_send(
+    serial, file, ncg, quiet=True, block_size=XMODEM_BLOCK_SIZE, progress=None
+):
+    """
+    Sends file by XMODEM in blocks of block_size. Returns whether the transfer
+    succeeded and the block size the receiver accepted, which falls back to
+    128 bytes if it rejects 1K blocks.
+    """
+    SOH = 0x01
+    STX = 0x02
     EOT = bytes(bytearray([0x04]))
     ACK = bytes(bytearray([0x06]))
     NAK = bytes(bytearray([0x15]))
     NCG = b"C"
-    DATA_SIZE = 128
     if not ncg:
         t = 0
         while True:
@@ -174,26 +180,50 @@ def xmodem_send(serial, file, ncg, quiet=True):
                 if t == 10:
                     print("*", end="")
                     sys.stdout.flush()
-                    return False
+                    return False, block_size
             else:
                 break
+    # Images are either seekable streams or buffers such as memoryview slices
+    if is_stream(file):
+        image = None
+        file.seek(0, os.SEEK_END)
+        file_size = file.tell()
+        file.seek(0)
+    else:
+        image = memoryview(file)
+        file_size = len(image)
+    # Each frame is built in place, block header, data, CRC, and sent in one write
+    frames = {}
+    for size in set([XMODEM_BLOCK_SIZE, block_size]):
+        frames[size] = bytearray(3 + size + 2)
+        frames[size][0] = STX if size == XMODEM_1K_BLOCK_SIZE else SOH
     pn = 1
-    file.seek(0)
-    data = bytearray(file.read(DATA_SIZE))
     tx_size = 0
-    while data:
-        for i in range(DATA_SIZE - len(data)):
-            data += bytes(bytearray([0xFF]))
-        crc = calc_crc(data)
+    while tx_size < file_size:
+        # Send the tail in small blocks so it is padded as in 128-byte mode
+        size = block_size
+        if file_size - tx_size < size:
+            size = XMODEM_BLOCK_SIZE
+        frame = frames[size]
+        data = memoryview(frame)[3 : 3 + size]
+        if image is None:
+            file.seek(tx_size)
+            length = file.readinto(data)
+            if not length:
+                break
+        else:
+            length = min(size, file_size - tx_size)
+            data[:length] = image[tx_size : tx_size + length]
+        frame[3 + length : 3 + size] = b"\xff" * (size - length)
+        frame[1] = pn
+        frame[2] = 0xFF - pn
+        crc = myriota_crc.crc16(data)
+        frame[-2] = (crc & 0xFF00) >> 8
+        frame[-1] = crc & 0xFF
         MAX_RETRIES = 1
         retries = 0
         while True:
-            serial.write(SOH)
-            serial.write(bytes(bytearray([pn])))
-            serial.write(bytes(bytearray([0xFF - pn])))
-            serial.write(data)
-            serial.write(bytes(bytearray([(crc & 0xFF00) >> 8])))
-            serial.write(bytes(bytearray([crc & 0xFF])))
+            serial.write(frame)
             serial.flush()
             answer = serial.read(1)
             if answer == NAK:
@@ -201,16 +231,24 @@ def xmodem_send(serial, file, ncg, quiet=True):
                     print("!", end="")
                     sys.stdout.flush()
                 retries += 1
-                if retries > MAX_RETRIES:
-                    return False
-                else:
+                if retries <= MAX_RETRIES:
                     continue
+                if size == XMODEM_BLOCK_SIZE:
+                    return False, block_size
+                # Fall back to 128-byte blocks and resend this block number
+                if not quiet:
+                    print("~", end="")
+                    sys.stdout.flush()
+                block_size = XMODEM_BLOCK_SIZE
+                break
             if answer == ACK:
-                retries = 0
-                tx_size += DATA_SIZE
-                if not tx_size % (1024 * 10):
+                tx_size += size
+                if progress is not None:
+                    progress(tx_size, file_size)
+                elif not tx_size % (1024 * 10):
                     print(".", end="")
                     sys.stdout.flush()
+                pn = (pn + 1) % 256
                 break
             # If got nothing, exit
             serial.write(EOT)
@@ -218,23 +256,22 @@ def xmodem_send(serial, file, ncg, quiet=True):
             if not quiet:
                 print("$", end="")
                 sys.stdout.flush()
-            return False
-        data = bytearray(file.read(DATA_SIZE))
-        pn = (pn + 1) % 256
+            return False, block_size
     serial.write(EOT)
     serial.flush()
     answer = serial.read(1)
     if answer == NAK:
-        return False
-    return True
+        return False, block_size
+    return True, block_size
 
 
-def update_stream(ser, command, stream):
+def update_stream(ser, command, stream, block_size=XMODEM_BLOCK_SIZE, progress=None):
     sys.stdout.flush()
     retries = 3
     update_in_progress = False
     while True:
-        stream.seek(0)
+        if is_stream(stream):
+            stream.seek(0)
         ser.reset_input_buffer()
         ser.write(bytearray(command.encode("utf-8")))
         ser.flush()
@@ -255,8 +292,13 @@ def update_stream(ser, command, stream):
                 return False
         if b"Ready" in out and not b"Fail" in out:
             update_in_progress = True
-            if xmodem_send(ser, stream, ncg):
-                stream.close()
+            # a fallback to 128-byte blocks holds for the retries
+            passed, block_size = xmodem_send(
+                ser, stream, ncg, block_size=block_size, progress=progress
+            )
+            if passed:
+                if is_stream(stream):
+                    stream.close()
                 return True
         retries -= 1
         if retries == 0:
@@ -268,7 +310,9 @@ def update_stream(ser, command, stream):
     return False
 
 
-def update_image(ser, command, filename, handle=None):
+def update_image(
+    ser, command, filename, handle=None, block_size=XMODEM_BLOCK_SIZE, progress=None
+):
     try:
         if handle is None:
             stream = open(filename, "rb")
@@ -279,14 +323,181 @@ def update_image(ser, command, filename, handle=None):
         sys.stderr.write("\nCan't open %s\n" % filename)
         return False
 
-    stream.seek(0, os.SEEK_END)
-    file_size = stream.tell()
-    stream.seek(0, os.SEEK_SET)
-    print(
-        "\nProgramming %s (%dK) " % (filename, (file_size + 1023) / 1024),
-        end="",
-    )
-    return update_stream(ser, command, stream)
+    if is_stream(stream):
+        stream.seek(0, os.SEEK_END)
+        file_size = stream.tell()
+        stream.seek(0, os.SEEK_SET)
+    else:
+        file_size = len(memoryview(stream))
+    if progress is None:
+        print(
+            "\nProgramming %s (%dK) " % (filename, (file_size + 1023) / 1024),
+            end="",
+        )
+    return update_stream(ser, command, stream, block_size, progress)
+
+
+USER_APP_START_ADDRESS = 0x24800
+FLASH_PAGE_SIZE = 2048
+DELTA_CACHE_DIR = os.path.expanduser("~") + "/.cache/myriota/updater"
+
+
+# Cached images are preceded by their length and CRC
+delta_cache_header = struct.Struct("<4sIH")
+DELTA_CACHE_MAGIC = b"MDC1"
+
+
+def delta_cache_file(module_id):
+    name = "".join(c for c in module_id if c.isalnum())
+    return os.path.join(DELTA_CACHE_DIR, name + ".bin")
+
+
+def read_delta_cache(module_id):
+    """
+    Returns the user application last flashed to module_id, or None if not
+    cached or the cache is corrupt
+    """
+    try:
+        with open(delta_cache_file(module_id), "rb") as f:
+            data = f.read()
+    except IOError:
+        return None
+    if len(data) < delta_cache_header.size:
+        return None
+    magic, length, crc = delta_cache_header.unpack_from(data)
+    image = data[delta_cache_header.size :]
+    if (
+        magic != DELTA_CACHE_MAGIC
+        or length != len(image)
+        or crc != myriota_crc.crc16(image)
+    ):
+        return None
+    return image
+
+
+def write_delta_cache(module_id, image):
+    try:
+        os.makedirs(DELTA_CACHE_DIR)
+    except OSError as e:
+        # created meanwhile by another station thread
+        if e.errno != errno.EEXIST:
+            raise
+    filename = delta_cache_file(module_id)
+    with open(filename + ".tmp", "wb") as f:
+        f.write(
+            delta_cache_header.pack(
+                DELTA_CACHE_MAGIC, len(image), myriota_crc.crc16(image)
+            )
+        )
+        f.write(image)
+    replace_file(filename + ".tmp", filename)
+
+
+def clear_delta_cache(module_id):
+    try:
+        os.remove(delta_cache_file(module_id))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def update_delta_cache(module_id, image, passed):
+    """
+    Caches image as the user application of module_id once written, or
+    invalidates the cache if the write failed. Cache errors are only
+    reported, as they do not affect the device.
+    """
+    try:
+        if passed:
+            write_delta_cache(module_id, image)
+        else:
+            clear_delta_cache(module_id)
+    except (IOError, OSError) as e:
+        sys.stderr.write("Failed to update delta cache of %s: %s\n" % (module_id, e))
+
+
+def invalidate_delta_cache(module_id, command):
+    """
+    Invalidates the delta cache of module_id on a plain write of command.
+    Writes other than of the system image and network information may have
+    changed the user application.
+    """
+    if command in ("o", "a%x" % FIRMWARE_START_ADDRESS):
+        return
+    try:
+        clear_delta_cache(module_id)
+    except OSError as e:
+        sys.stderr.write("Failed to clear delta cache of %s: %s\n" % (module_id, e))
+
+
+def delta_regions(old, new, page_size=FLASH_PAGE_SIZE):
+    """
+    Returns (offset, length) of the page aligned regions of new that differ
+    from old, merging adjacent pages into one region.
+    """
+    old = memoryview(old)
+    new = memoryview(new)
+    regions = []
+    for offset in range(0, len(new), page_size):
+        page = new[offset : offset + page_size]
+        if page == old[offset : offset + page_size]:
+            continue
+        if regions and sum(regions[-1]) == offset:
+            regions[-1] = (regions[-1][0], regions[-1][1] + len(page))
+        else:
+            regions.append((offset, len(page)))
+    return regions
+
+
+def update_image_delta(
+    ser, module_id, filename, image, block_size=XMODEM_BLOCK_SIZE, progress=None
+):
+    """
+    Updates the user application on module_id by writing only the flash pages
+    that differ from the image cached from its last delta update, using
+    addressed writes. Writes the full image if the cache is missing or stale.
+    Returns a tuple of success and the number of bytes not written.
+    """
+    image = memoryview(image)
+    cached = read_delta_cache(module_id)
+    regions = None
+    # A shrinking image would leave stale pages behind, and beyond half the
+    # image changed a single full write is quicker than many small ones
+    if cached is not None and len(image) >= len(cached):
+        regions = delta_regions(cached, image)
+        if sum(length for _, length in regions) > len(image) // 2:
+            regions = None
+    if regions is None:
+        if progress is None:
+            print("\nNo usable delta cache for %s, writing full image" % module_id)
+        passed = update_image(ser, "s", filename, image, block_size, progress)
+        saved = 0
+    else:
+        passed = True
+        for offset, length in regions:
+            passed = update_image(
+                ser,
+                "a%x" % (USER_APP_START_ADDRESS + offset),
+                "%s@0x%x" % (filename, offset),
+                image[offset : offset + length],
+                block_size,
+                progress,
+            )
+            if not passed:
+                break
+        saved = len(image) - sum(length for _, length in regions)
+        if not passed:
+            sys.stderr.write("Delta update failed, writing full image\n")
+            passed = update_image(ser, "s", filename, image, block_size, progress)
+            saved = 0
+        elif progress is None:
+            print(
+                "\nDelta update of %s wrote %d of %d bytes, saved %d bytes"
+                % (filename, len(image) - saved, len(image), saved),
+                end="",
+            )
+    update_delta_cache(module_id, image, passed)
+    return passed, saved
 
 
 def jump_to_app(ser):
@@ -294,7 +505,7 @@ def jump_to_app(ser):
     ser.flush()
 
 
-def get_id(ser):
+def get_id(ser, quiet=False):
     MAX_RETRIES = 2
     retries = 0
     while True:
@@ -307,12 +518,13 @@ def get_id(ser):
         if b"Unknown" in out:
             retries += 1
         else:
-            print("ID:", end="")
-            print(out.decode("utf-8"))
-            break
+            if not quiet:
+                print("ID:", end="")
+                print(out.decode("utf-8"))
+            return out.decode("utf-8").strip()
         if retries > MAX_RETRIES:
             sys.stderr.write("Failed to read ID\n")
-            break
+            return None
 
 
 def get_regcode(ser):
@@ -384,74 +596,277 @@ header_length = 16
 header_version = 0
 
 
-def is_merged_binary(filename):
-    try:
-        with open(filename, "rb") as input_file:
-            totalsize = os.stat(filename).st_size
+class MergedBinary(object):
+    """
+    Memory mapped merged binary. Headers and checksums of all sections are
+    validated on open, and sections are exposed as memoryview slices of the
+    mapping without copying.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.sections = []
+        self._file = open(filename, "rb")
+        try:
+            totalsize = os.fstat(self._file.fileno()).st_size
             if totalsize <= header_length:
-                return False
+                raise ValueError("%s is too small" % filename)
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            self._file.close()
+            raise ValueError("%s is not a merged binary" % filename)
+        try:
+            view = memoryview(self._map)
+        except TypeError:
+            # Python 2 mmap does not support memoryview, so use a copy
+            view = memoryview(self._map[:])
+        offset = 0
+        while offset < totalsize:
+            if totalsize - offset < header_length:
+                self.close()
+                raise ValueError("Truncated header in %s" % filename)
+            _, _, ftype, flen, _, _, checksum = struct.unpack_from(
+                "<BBHIIHH", view, offset
+            )
+            end = offset + header_length + flen
+            if not ftype in file_types or end > totalsize:
+                self.close()
+                raise ValueError("Invalid header in %s" % filename)
+            # checksum covers the header, with the checksum itself zeroed
+            crc = myriota_crc.crc16(view[offset : offset + header_length - 2])
+            crc = myriota_crc.crc16(b"\x00\x00", crc)
+            data = view[offset + header_length : end]
+            if checksum != myriota_crc.crc16(data, crc):
+                self.close()
+                raise ValueError("Checksum error in %s" % filename)
+            self.sections.append((ftype, data))
+            offset = end
+
+    def close(self):
+        self.sections = []
+        try:
+            self._map.close()
+        except (AttributeError, BufferError):
+            # sections still referenced elsewhere keep the mapping alive
+            pass
+        self._file.close()
+
 
-            offset = 0
-            while offset < totalsize:
-                input_file.seek(2, os.SEEK_CUR)
-                ftype = struct.unpack("<H", input_file.read(2))[0]
-                if not ftype in file_types:
-                    return False
-
-                flen = struct.unpack("<I", input_file.read(4))[0]
-                reserved = struct.unpack("<I", input_file.read(4))[0]
-                reserved = struct.unpack("<H", input_file.read(2))[0]
-                checksum = struct.unpack("<H", input_file.read(2))[0]
-                input_file.seek(0 - header_length, os.SEEK_CUR)
-                data = bytearray(input_file.read(header_length + flen))
-                data[14] = data[15] = 0
-                if checksum != (calc_crc(data) & 0xFFFF):
-                    return False
-
-                offset += header_length + flen
-            return True
+def read_merged_binary(filename):
+    """Returns the validated MergedBinary in filename or None if not merged"""
+    try:
+        return MergedBinary(filename)
+    except ValueError:
+        return None
     except IOError:
         sys.stderr.write("Can't open %s\n" % filename)
         sys.exit(1)
 
 
-def append_merged_files(filename, command):
-    with open(filename, "rb") as input_file:
-        offset = 0
-        while offset < os.stat(filename).st_size:
-            header_version = struct.unpack("<B", input_file.read(1))[0]
-            reserved = struct.unpack("<B", input_file.read(1))[0]
-            ftype = struct.unpack("<H", input_file.read(2))[0]
-            flen = struct.unpack("<I", input_file.read(4))[0]
-            input_file.seek(8, os.SEEK_CUR)
-            output_temp = tempfile.NamedTemporaryFile(mode="w+b", delete=False)
-            output_temp.write(input_file.read(flen))
-            if ftype == 1:
-                command.append(
-                    [
-                        "a%x" % FIRMWARE_START_ADDRESS,
-                        filename + "(" + file_types.get(ftype) + ")",
-                        output_temp,
-                    ]
-                )
-            if ftype == 2:
-                command.append(
-                    [
-                        "s",
-                        filename + "(" + file_types.get(ftype) + ")",
-                        output_temp,
-                    ]
+def is_merged_binary(filename):
+    merged = read_merged_binary(filename)
+    if merged is None:
+        return False
+    merged.close()
+    return True
+
+
+merged_commands = {
+    1: "a%x" % FIRMWARE_START_ADDRESS,
+    2: "s",
+    3: "o",
+}
+
+
+def append_merged_files(merged, command):
+    for ftype, data in merged.sections:
+        command.append(
+            [
+                merged_commands[ftype],
+                merged.filename + "(" + file_types.get(ftype) + ")",
+                data,
+            ]
+        )
+
+
+def get_update_commands(args):
+    update_commands = []
+    if args.system_image_name:
+        update_commands.append(
+            ["a%x" % FIRMWARE_START_ADDRESS, args.system_image_name, None]
+        )
+    if args.user_app_name:
+        merged = read_merged_binary(args.user_app_name)
+        if merged is not None:
+            append_merged_files(merged, update_commands)
+        else:
+            update_commands.append(["s", args.user_app_name, None])
+    if args.network_info_bin_name:
+        update_commands.append(["o", args.network_info_bin_name, None])
+    if args.merged_bin_name:
+        merged = read_merged_binary(args.merged_bin_name)
+        if merged is not None:
+            append_merged_files(merged, update_commands)
+        else:
+            sys.stderr.write("Failed to extract files\n")
+            sys.exit(1)
+    if args.raw_commands is not None:
+        for raw_command in args.raw_commands:
+            raw_command.append(None)
+        update_commands += args.raw_commands
+    if args.test_image_name:
+        update_commands.append(
+            ["a%x" % FIRMWARE_START_ADDRESS, args.test_image_name, None]
+        )
+    return update_commands
+
+
+def load_images(update_commands):
+    """
+    Reads every image to update with into memory once, so that it can be
+    shared by all devices of a flashing station.
+    """
+    images = []
+    for command, filename, handle in update_commands:
+        try:
+            if handle is None:
+                with open(filename, "rb") as f:
+                    data = f.read()
+            elif is_stream(handle):
+                handle.seek(0)
+                data = handle.read()
+            else:
+                data = handle
+        except IOError:
+            sys.stderr.write("Can't open %s\n" % filename)
+            sys.exit(1)
+        images.append([command, filename, data])
+    return images
+
+
+class StationProgress(object):
+    """Reports per-device progress of a flashing station on stderr"""
+
+    def __init__(self, step=10):
+        self.step = step
+        self.lock = threading.Lock()
+
+    def report(self, portname, message):
+        with self.lock:
+            sys.stderr.write("%s: %s\n" % (portname, message))
+            sys.stderr.flush()
+
+    def image(self, portname, filename):
+        state = {"last": -1}
+
+        def progress(tx_size, file_size):
+            percent = 100 * tx_size // max(file_size, 1)
+            if percent // self.step != state["last"]:
+                state["last"] = percent // self.step
+                self.report(portname, "%s %d%%" % (filename, percent))
+
+        return progress
+
+
+def flash_device(portname, baudrate, images, block_size, start, progress, delta):
+    """
+    Captures the bootloader of the device on portname, reads its ID and
+    programs images, updating the user application by delta if requested.
+    Returns a dictionary summarising the result.
+    """
+    result = {
+        "port": portname,
+        "id": None,
+        "passed": False,
+        "error": None,
+        "images": [],
+    }
+    start_time = time.time()
+    ser = None
+    try:
+        ser = open_serial_port(portname, baudrate)
+        progress.report(portname, "capturing bootloader")
+        capture_bootloader(ser, lambda message: progress.report(portname, message))
+        result["id"] = get_id(ser, quiet=True)
+        progress.report(portname, "ID %s" % result["id"])
+        for command, filename, data in images:
+            image_time = time.time()
+            saved = 0
+            if delta and command == "s" and result["id"]:
+                passed, saved = update_image_delta(
+                    ser,
+                    result["id"],
+                    filename,
+                    data,
+                    block_size,
+                    progress.image(portname, filename),
                 )
-            if ftype == 3:
-                command.append(
-                    [
-                        "o",
-                        filename + "(" + file_types.get(ftype) + ")",
-                        output_temp,
-                    ]
+            else:
+                passed = update_image(
+                    ser,
+                    command,
+                    filename,
+                    data,
+                    block_size,
+                    progress.image(portname, filename),
                 )
-            output_temp.flush()
-            offset += flen + header_length
+                if result["id"]:
+                    invalidate_delta_cache(result["id"], command)
+            result["images"].append(
+                {
+                    "name": filename,
+                    "passed": passed,
+                    "saved": saved,
+                    "seconds": round(time.time() - image_time, 3),
+                }
+            )
+            if not passed:
+                raise IOError("Update of %s failed" % filename)
+        if start:
+            jump_to_app(ser)
+        result["passed"] = True
+    except (IOError, OSError, serial.SerialException) as e:
+        result["error"] = str(e)
+    finally:
+        if ser is not None:
+            ser.close()
+    result["seconds"] = round(time.time() - start_time, 3)
+    progress.report(portname, "passed" if result["passed"] else "FAILED")
+    return result
+
+
+def flash_station(
+    portnames, baudrate, update_commands, block_size, start=False, delta=False
+):
+    """
+    Updates all devices on portnames concurrently and prints a JSON summary.
+    Returns True if every device passed.
+    """
+    images = load_images(update_commands)
+    progress = StationProgress()
+    start_time = time.time()
+    results = [None] * len(portnames)
+
+    def flash(i):
+        results[i] = flash_device(
+            portnames[i], baudrate, images, block_size, start, progress, delta
+        )
+
+    # one thread per device, as each mostly waits on its serial port
+    threads = [threading.Thread(target=flash, args=(i,)) for i in range(len(portnames))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    passed = len([r for r in results if r["passed"]])
+    summary = {
+        "devices": results,
+        "passed": passed,
+        "failed": len(results) - passed,
+        "seconds": round(time.time() - start_time, 3),
+    }
+    print(json.dumps(summary, indent=2))
+    return bool(results) and passed == len(results)
 
 
 def main():
@@ -520,6 +935,20 @@ def main():
         default=port_name,
         help="serial PORT the Myriota device is connected to, e.g. /dev/ttyUSB0",
     )
+    parser.add_argument(
+        "--ports",
+        dest="portnames",
+        nargs="+",
+        metavar="PORT",
+        help="update the devices on all PORTs concurrently and print a JSON summary",
+    )
+    parser.add_argument(
+        "--all-ports",
+        dest="all_ports_flag",
+        action="store_true",
+        default=False,
+        help="update the devices on all available serial ports concurrently",
+    )
     parser.add_argument(
         "-w",
         "--wait",
@@ -569,6 +998,26 @@ def main():
         help="set the serial port BAUDRATE between 9600 and 921600",
     )
 
+    parser.add_argument(
+        "-k",
+        "--xmodem-1k",
+        dest="xmodem_1k_flag",
+        action="store_true",
+        default=False,
+        help="send 1024-byte XMODEM-1K blocks, falling back to 128-byte blocks if rejected",
+    )
+
+    parser.add_argument(
+        "-D",
+        "--delta",
+        dest="delta_flag",
+        action="store_true",
+        default=False,
+        help="only write the flash pages of the user application that changed since "
+        "its last delta update, cached per module ID in " + DELTA_CACHE_DIR + ". "
+        "Use -D for every update of a module, as updates without it are not tracked",
+    )
+
     parser.add_argument(
         "-d",
         "--default-port",
@@ -602,7 +1051,14 @@ def main():
         if serial.tools.list_ports.comports():
             port_name = serial.tools.list_ports.comports()[0].device
 
-    if port_name == "None" and args.portname == "None":
+    station_ports = args.portnames
+    if args.all_ports_flag:
+        station_ports = sorted(get_ports())
+        if not station_ports:
+            sys.stderr.write("No serial ports found\n")
+            sys.exit(1)
+
+    if port_name == "None" and args.portname == "None" and station_ports is None:
         port_name = detect_port()
 
     if args.portname != "None":
@@ -620,6 +1076,24 @@ def main():
     else:
         br = 115200
 
+    if args.xmodem_1k_flag:
+        block_size = XMODEM_1K_BLOCK_SIZE
+    else:
+        block_size = XMODEM_BLOCK_SIZE
+
+    if station_ports is not None:
+        update_commands = get_update_commands(args)
+        if not flash_station(
+            station_ports,
+            br,
+            update_commands,
+            block_size,
+            args.start_flag,
+            args.delta_flag,
+        ):
+            sys.exit(1)
+        sys.exit(0)
+
     if args.debug:
         print("Entering interactive debug mode")
         cmd = "python -m serial.tools.miniterm --raw " + port_name + " " + str(br)
@@ -647,36 +1121,24 @@ def main():
         get_version(serial_port)
         sys.exit(0)
 
-    update_commands = []
-    if args.system_image_name:
-        update_commands.append(
-            ["a%x" % FIRMWARE_START_ADDRESS, args.system_image_name, None]
-        )
-    if args.user_app_name:
-        if is_merged_binary(args.user_app_name):
-            append_merged_files(args.user_app_name, update_commands)
-        else:
-            update_commands.append(["s", args.user_app_name, None])
-    if args.network_info_bin_name:
-        update_commands.append(["o", args.network_info_bin_name, None])
-    if args.merged_bin_name:
-        if is_merged_binary(args.merged_bin_name):
-            append_merged_files(args.merged_bin_name, update_commands)
-        else:
-            sys.stderr.write("Failed to extract files\n")
-            sys.exit(1)
-    if args.raw_commands is not None:
-        args.raw_commands[0].extend([None])
-        update_commands += args.raw_commands
-    if args.test_image_name:
-        update_commands.append(
-            ["a%x" % FIRMWARE_START_ADDRESS, args.test_image_name, None]
-        )
+    update_commands = get_update_commands(args)
 
     if update_commands:
         capture_bootloader(serial_port)
+        module_id = None
+        if args.delta_flag:
+            module_id = get_id(serial_port)
+            update_commands = load_images(update_commands)
         for d in update_commands:
-            if update_image(serial_port, d[0], d[1], d[2]):
+            if module_id is not None and d[0] == "s":
+                passed, _ = update_image_delta(
+                    serial_port, module_id, d[1], d[2], block_size
+                )
+            else:
+                passed = update_image(serial_port, d[0], d[1], d[2], block_size)
+                if module_id is not None:
+                    invalidate_delta_cache(module_id, d[0])
+            if passed:
                 print("done", end="")
             else:
                 sys.stderr.write("Update failed!\n")
@@ -695,4 +1157,9 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except IOError as e:
+        # failures to open the serial port or capture the bootloader
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)